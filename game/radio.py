@@ -10,14 +10,18 @@ from numpy.fft import fft
 from math import log10 
 import math
 from random import randint
-import copy
-import game.globals as globals
-+import mutagen.oggvorbis
+import wave
+from pypboy import config
+from pypboy.data import PcmStream, Spectrogram, SpectrumPrecomputer
+try:
+	import mutagen
+except ImportError:
+	mutagen = None
 
 
 class Radio(game.Entity):
 	def __init__(self):
-		super(Radio, self).__init__((globals.WIDTH, globals.HEIGHT))
+		super(Radio, self).__init__((config.WIDTH, config.HEIGHT))
 		# set up the mixer
 		
 		try: pygame.mixer.quit()
@@ -33,14 +37,28 @@ class Radio(game.Entity):
 		self.paused = True
 		self.loaded = False
 		self.spectrum = None 
+		self.waveform = None
 		self.filename = ""
+		self.title = ""
+		self.precomputer = None
 	
 	def play_rnd(self):
 		files = load_files()
 		file = files[randint(0,len(files)-1)]
 		self.filename = file
+		self.title = track_title(file)
+		if self.precomputer is None:
+			# have the rest of the library's spectra ready before they're played
+			self.precomputer = SpectrumPrecomputer([f for f in files if f != file],
+				processes=config.SPECTRUM_BACKGROUND_PROCESSES)
+			self.precomputer.start()
 		pygame.mixer.music.load(file)
-		self.spectrum = LogSpectrum(file,force_mono=True) 
+		if self.spectrum:
+			self.spectrum.close()
+		self.spectrum = Spectrogram(file)
+		if self.waveform:
+			self.waveform.stream.close()
+		self.waveform = load_waveform(file)
 		pygame.mixer.music.play()
 		self.loaded = True
 		self.paused = False
@@ -61,35 +79,29 @@ class Radio(game.Entity):
 
 	def render(self, *args, **kwargs):
 		if not self.paused :
-			f,p = None,[0 for i in range(21)]
+			f,p,samples = None,[0 for i in range(21)],None
 			start = pygame.mixer.music.get_pos() / 1000.0
 			try:
 				f,p = self.spectrum.get_mono(start-0.001, start+0.001)
+				samples = waveform_at(self.waveform, start, self.osc.WIDTH)
 			except:
 				pass
-			self.osc.update(start*50,f,p)	
+			self.osc.update(start*50,f,p,samples)	
 		if self.osc:
 			self.blit(self.osc.screen, (550, 150))
-            
-            metadata = mutagen.File(filename, easy = True)
 			
 		selectFont = pygame.font.Font('monofonto.ttf', 24)
 		basicFont = pygame.font.Font('monofonto.ttf', 22)
-        
-        text = selectFont.render(game.Entity.name, True, (105, 251, 187), (0, 0, 0))
-        
-		#text = selectFont.render(" -   Random Play Radio ", True, (105, 251, 187), (0, 0, 0))
 		
-        self.blit(text, (75, 75))
+		text = selectFont.render(" -   Random Play Radio ", True, (105, 251, 187), (0, 0, 0))
+		self.blit(text, (75, 75))
 		text = basicFont.render("  'r' selects a random song ", True, (105, 251, 187), (0, 0, 0))
 		self.blit(text, (75, 100))
 		text = basicFont.render("  'p' to play   's' to stop ", True, (105, 251, 187), (0, 0, 0))
 		self.blit(text, (75, 120))
 		
 		if self.filename:
-            text = selectFont.render(" %s " % metadata["ARTIST"] + ' - ' + metadata["TITLE"], True, (105, 251, 187), (0, 0, 0))
-            
-			#text = selectFont.render(u" %s " % self.filename[self.filename.rfind(os.sep)+1:], True, (105, 251, 187), (0, 0, 0))
+			text = selectFont.render(u" %s " % self.title, True, (105, 251, 187), (0, 0, 0))
 			self.blit(text, (75, 200))
 			
 		super(Radio, self).update(*args, **kwargs)
@@ -114,7 +126,7 @@ class Oscilloscope:
 			self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT), 0)
 				
 		# Create a blank chart with vertical ticks, etc
-		self.blank = numpy.zeros((self.WIDTH, self.HEIGHT, 3))
+		self.blank = numpy.zeros((self.WIDTH, self.HEIGHT, 3), dtype=numpy.uint8)
 		# Draw x-axis
 		self.xaxis = self.HEIGHT/2
 		self.blank[::, self.xaxis] = self.GREY
@@ -136,37 +148,106 @@ class Oscilloscope:
 		pygame.surfarray.blit_array(self.screen, self.blank)	  # Blit the screen buffer
 		pygame.display.flip()									 # Flip the double buffer
 		
+		# Frame buffer reused by update, and the band of each column
+		self.pixels = numpy.empty_like(self.blank)
+		self.columns = numpy.arange(self.WIDTH, dtype=numpy.float64)
+		self.rows = numpy.arange(self.HEIGHT)
+		self.bands = numpy.arange(self.WIDTH) // 10
+		
 			
-	def update(self,time,frequency,power):
+	def update(self, time, frequency, power, samples=None):
+		"""
+		Draw the PCM samples given, a whole number of them per column, 
+		or else a sine trace scaled by the power in each band. 
+		"""
 		try:
-			pixels = copy.copy(self.blank)
-			offset = 1
-			for x in range(self.WIDTH):
-				offset = offset - 1
-				if offset < -1:
-					offset = offset + 1.1		 
-				try:
-					pow = power[int(x/10)]
-					log = math.log10( pow )
-					offset = ((pow / math.pow(10, math.floor(log))) + log)*1.8
-				except:
-					pass
-				try: 
-					y = float(self.xaxis) - (math.sin((float(x)+float(time))/5.0)*2.0*offset) 
-					pixels[x][y] = self.TRACE
-					pixels[x][y-1] = self.AFTER
-					pixels[x][y+1] = self.AFTER
-					if abs(y) > 120:
-						pixels[x][y-2] = self.AFTER
-						pixels[x][y+2] = self.AFTER
-				except: 
-					pass
-			pygame.surfarray.blit_array(self.screen, pixels)	 # Blit the screen buffer
+			self.pixels[...] = self.blank
+			if samples is not None and len(samples) >= self.WIDTH:
+				# the range of the samples under each column
+				columns = numpy.reshape(samples[:len(samples) // self.WIDTH * self.WIDTH], (self.WIDTH, -1))
+				scale = (self.xaxis - 10) / 32768.0
+				top = self.xaxis - columns.max(axis=1) * scale
+				bottom = self.xaxis - columns.min(axis=1) * scale
+			else:
+				y = self.xaxis - numpy.sin((self.columns + time) / 5.0) * 2.0 * self.offsets(power)
+				# join each column to the one before
+				previous = numpy.concatenate((y[:1], y[:-1]))
+				top, bottom = numpy.minimum(y, previous), numpy.maximum(y, previous)
+			self.trace(top, bottom)
+			pygame.surfarray.blit_array(self.screen, self.pixels)	 # Blit the screen buffer
 			if not self.embedded:
 				pygame.display.flip()  
 		except Exception,e:
 			logging.error(traceback.format_exc())
 
+	def offsets(self, power):
+		"""
+		Return the trace amplitude of each column from the power of 
+		the band it falls in, flat where there is no power. 
+		"""
+		offsets = numpy.zeros(self.WIDTH)
+		if power is None:
+			return offsets
+		power = numpy.asarray(power, dtype=numpy.float64)
+		bands = self.bands[self.bands < len(power)]
+		pow = power[bands]
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			log = numpy.log10(pow)
+			scaled = ((pow / 10 ** numpy.floor(log)) + log) * 1.8
+		offsets[:len(bands)] = numpy.where((pow > 0) & numpy.isfinite(scaled), scaled, 0)
+		return offsets
+
+	def trace(self, top, bottom):
+		"""
+		Fill each column between top and bottom, with an afterglow 
+		above and below. 
+		"""
+		top = numpy.clip(top, 0, self.HEIGHT - 1).astype(int)[:, numpy.newaxis]
+		bottom = numpy.clip(bottom, 0, self.HEIGHT - 1).astype(int)[:, numpy.newaxis]
+		self.pixels[(self.rows >= top - 1) & (self.rows <= bottom + 1)] = self.AFTER
+		self.pixels[(self.rows >= top) & (self.rows <= bottom)] = self.TRACE
+
+def load_files(directory='sounds/radio/gnr/'):
+	"""
+	Return the tracks in a radio station's directory. 
+	"""
+	return [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+			if f.endswith(('.mp3', '.ogg', '.wav'))]
+
+def track_title(file):
+	"""
+	Return "artist - title" from a track's tags if mutagen is installed 
+	and can read them, or else its file name. 
+	"""
+	if mutagen is not None:
+		try:
+			metadata = mutagen.File(file, easy=True)
+		except Exception, e:
+			logging.info("No tags in {0}: {1}".format(file, e))
+			metadata = None
+		if metadata and 'artist' in metadata and 'title' in metadata:
+			return metadata['artist'][0] + ' - ' + metadata['title'][0]
+	return file[file.rfind(os.sep)+1:]
+
+def load_waveform(file):
+	"""
+	Return the mono samples of a WAV file for the oscilloscope, or 
+	None for formats that can only be decoded whole. 
+	"""
+	try:
+		return PcmStream(file, seconds=0.5).channel('mono')
+	except (wave.Error, EOFError, ValueError), e:
+		return None
+
+def waveform_at(waveform, start, width, per_column=4):
+	"""
+	Return width * per_column samples of waveform from start in 
+	seconds, or None without a waveform. 
+	"""
+	if waveform is None:
+		return None
+	return waveform.frames(int(start * waveform.stream.rate), width * per_column)
+
 def play_pygame(file):
 	
 	clock = pygame.time.Clock()
@@ -181,12 +262,14 @@ def play_pygame(file):
 		clock.tick(50)
 	
 	pygame.mixer.music.load(file)
-	s = LogSpectrum(file,force_mono=True) 
+	s = Spectrogram(file)
+	w = load_waveform(file)
 	osc = Oscilloscope() 
 	osc.open()
 	
 	f = None
 	p = None
+	samples = None
 	running = True
 	paused = False
 	pygame.mixer.music.play()
@@ -196,9 +279,10 @@ def play_pygame(file):
 			start = pygame.mixer.music.get_pos() / 1000.0
 			try:
 				f,p = s.get_mono(start-0.001, start+0.001)
+				samples = waveform_at(w, start, osc.WIDTH)
 			except:
 				pass
-			osc.update(start*50,f,p)			 
+			osc.update(start*50,f,p,samples)			 
 		pygame.time.wait(50)
 		
 		for event in pygame.event.get():
@@ -0,0 +1,27 @@
+# Imports a local OpenStreetMap .osm XML extract into the offline map database,
+# so the maps work on a Pip Boy with no network connection.
+# Usage: python import_map.py extract.osm [database]
+import logging
+import sys
+import time
+
+from pypboy import config
+from pypboy.data import MapDatabase
+
+
+
+def main(argc, argv):
+    if argc < 2:
+        print("Usage: python import_map.py extract.osm [database]")
+        return 1
+    logging.getLogger().setLevel(logging.INFO)
+    database = MapDatabase(argv[2] if argc > 2 else config.MAP_DATABASE)
+    started = time.time()
+    ways = database.import_osm(argv[1])
+    logging.info("Imported {0} ways from {1} into {2} in {3:.1f}s".format(
+        ways, argv[1], database.path, time.time() - started))
+    logging.info("Coverage: {0}".format(database.coverage()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(len(sys.argv), sys.argv))
@@ -0,0 +1,41 @@
+# Analyses radio tracks ahead of time, using every core, so their spectra are
+# ready before they're first played. Tracks analysed already are skipped.
+# Usage: python precompute_spectra.py [--processes N] [--cache directory] [directory or track ...]
+import argparse
+import logging
+import os
+import sys
+import time
+
+from pypboy import config
+from pypboy.data import SpectrumPrecomputer
+
+EXTENSIONS = ('.mp3', '.ogg', '.wav')
+
+
+def progress(done, total, filename):
+    logging.info("[{0}/{1}] {2}".format(done, total, filename))
+
+
+def main(argc, argv):
+    parser = argparse.ArgumentParser(description="Precompute radio track spectra.")
+    parser.add_argument('--processes', type=int, default=None, help="tracks analysed at once, one per core by default")
+    parser.add_argument('--cache', default=config.SPECTRUM_CACHE_DIR, help="where the spectra are saved")
+    parser.add_argument('paths', nargs='*', default=['sounds/radio/gnr/'], help="tracks, or directories of them")
+    args = parser.parse_args(argv[1:])
+    logging.getLogger().setLevel(logging.INFO)
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(EXTENSIONS))
+        else:
+            files.append(path)
+    precomputer = SpectrumPrecomputer(files, args.cache, args.processes, progress)
+    started = time.time()
+    analysed = precomputer.run()
+    logging.info("Analysed {0} of {1} tracks in {2:.1f}s, {3} failed".format(
+        analysed, len(files), time.time() - started, len(precomputer.failed)))
+    return 1 if precomputer.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(len(sys.argv), sys.argv))
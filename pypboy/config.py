@@ -12,6 +12,37 @@ HEIGHT = 320
 # MAP_FOCUS = (-102.3016145, 21.8841274)
 MAP_FOCUS = (-93.364857, 37.114619)  # Battlefield, MO
 
+# Slippy map zoom level of the tiles map data is fetched and stored in,
+# about 0.0055 degrees of longitude a side
+MAP_TILE_ZOOM = 16
+
+# Pixels the map moves per dial step
+MAP_PAN_STEP = 8
+
+# On-disk cache of OSM responses converted to binary map files, so a warm start doesn't hit the network
+MAP_CACHE_DIR = 'cache/maps'
+MAP_CACHE_SIZE = 64 * 1024 * 1024  # bytes
+MAP_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds before an entry is refreshed, if the network allows
+# Offline map database built from a local .osm extract with import_map.py
+MAP_DATABASE = 'maps.db'
+# Threads downloading map tiles at once
+MAP_FETCH_WORKERS = 4
+# Seconds to wait for the OSM API to (connect, send the next bytes) before retrying
+MAP_FETCH_TIMEOUT = (5, 30)
+# Pre-rendered map tiles, kept in memory up to this many pixels and saved as PNGs
+MAP_TILE_CACHE_PIXELS = 4 * 1024 * 1024
+MAP_TILE_CACHE_DIR = 'cache/tiles'
+MAP_TILE_CACHE_DISK_SIZE = 32 * 1024 * 1024  # bytes
+# Parsed map data kept in memory across all maps, in way points
+MAP_STORE_POINTS = 500000
+# Stop prefetching tiles ahead of a panning map once the store holds this many
+MAP_PREFETCH_POINTS = 300000
+
+# Precomputed radio track spectrograms, keyed by track path and modification time
+SPECTRUM_CACHE_DIR = 'cache/spectra'
+# Processes analysing tracks in the background while the UI runs, each holding a decoded track
+SPECTRUM_BACKGROUND_PROCESSES = 1
+
 EVENTS = {
     'SONG_END': pygame.USEREVENT + 1
 }
@@ -60,6 +91,18 @@ MAP_ICONS = {
     "sewer": pygame.image.load('images/map_icons/sewer.png'),
 }
 
+# Sizes map icons are pre-scaled to, smallest first
+MAP_ICON_SIZES = (10, 15)
+
+# (colour, line width) of each class of way in pypboy.data.WAY_STYLES
+MAP_WAY_STYLES = {
+    'major': ((95, 255, 177), 3),
+    'minor': ((85, 251, 167), 2),
+    'path': ((50, 150, 100), 1),
+    'building': ((35, 105, 70), 1),
+    'other': ((85, 251, 167), 1)
+}
+
 AMENITIES = {
     'pub': MAP_ICONS['vault'],
     'nightclub': MAP_ICONS['vault'],
@@ -83,6 +126,13 @@ AMENITIES = {
     'atm': MAP_ICONS['misc'],
 }
 
+# When map labels would overlap, the one whose amenity comes first here wins
+LABEL_PRIORITIES = [
+    'townhall', 'school', 'pharmacy', 'bank', 'marketplace', 'bus_station', 'cinema', 'theatre',
+    'pub', 'bar', 'nightclub', 'restaurant', 'cafe', 'fast_food', 'place_of_worship', 'fountain',
+    'drinking_water', 'atm', 'parking', 'bicycle_parking',
+]
+
 pygame.font.init()
 FONTS = {}
 for x in range(10, 28):
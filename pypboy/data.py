@@ -1,26 +1,1484 @@
+import atexit
+import bisect
+import hashlib
+import heapq
+import json
 import logging
-import xmltodict
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import wave
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import requests
 import numpy
-from numpy.fft import fft
+from numpy.fft import rfft
 from math import log10
 import math
 import pygame
 
+from pypboy import config
 
-class Maps(object):
-    nodes = {}
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+
+class MapCache(object):
+    """
+    Persistent on-disk cache of OSM API responses converted to MapFiles,
+    keyed by tile or bbox.
+    Entries are evicted least recently used first once the cache grows
+    past max_size bytes, and are due a refresh after max_age seconds.
+    """
+    INDEX_FILE = 'index.json'
+    # Seconds between saving the index when only its access times changed
+    SAVE_INTERVAL = 60
+
+    def __init__(self, directory, max_size, max_age):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._saved = time.time()
+        self._load_index()
+
+    @staticmethod
+    def key(bounds):
+        return "%.6f_%.6f_%.6f_%.6f" % tuple(bounds)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.map')
+
+    def get(self, key, allow_stale=False):
+        """
+        Return the path of a fresh cached response for key, or None.
+        With allow_stale an entry past max_age is returned too, for when
+        it can't be refreshed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self.path(key)):
+                self.misses += 1
+                return None
+            if not allow_stale and time.time() - entry['fetched'] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['accessed'] = time.time()
+            del self._entries[key]
+            self._entries[key] = entry
+            # a warm start hits every tile, so don't rewrite the index for each
+            self._dirty = True
+            if entry['accessed'] - self._saved > self.SAVE_INTERVAL:
+                self._save_index()
+            return self.path(key)
+
+    def put(self, key, chunks):
+        """
+        Store an iterable of byte chunks as the response for key and
+        return the path it was written to.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(key)
+        temp_path = "%s.%d.tmp" % (path, threading.current_thread().ident)
+        size = 0
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+            if key in self._entries:
+                self.size -= self._entries.pop(key)['size']
+            now = time.time()
+            self._entries[key] = {'size': size, 'fetched': now, 'accessed': now}
+            self.size += size
+            self._evict()
+            self._save_index()
+        return path
+
+    def close(self):
+        """
+        Save access times not yet written to the index.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'size': self.size
+        }
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self.size -= entry['size']
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            logging.info("[Map cache evicted %s]" % key)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['accessed']):
+            self._entries[key] = entry
+            self.size += entry['size']
+
+    def _save_index(self):
+        if not os.path.isdir(self.directory):
+            return
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self._entries, f)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rename(index_path + '.tmp', index_path)
+        self._dirty = False
+        self._saved = time.time()
+
+
+OSM_TAGS = ('name', 'amenity', 'highway', 'building')
+
+# Way classes, in the order they're drawn so that bigger roads go on top
+WAY_STYLES = ('other', 'building', 'path', 'minor', 'major')
+HIGHWAY_STYLES = {
+    'motorway': 'major', 'trunk': 'major', 'primary': 'major', 'secondary': 'major',
+    'motorway_link': 'major', 'trunk_link': 'major', 'primary_link': 'major', 'secondary_link': 'major',
+    'tertiary': 'minor', 'tertiary_link': 'minor', 'residential': 'minor', 'unclassified': 'minor',
+    'living_street': 'minor', 'service': 'minor', 'road': 'minor',
+    'footway': 'path', 'path': 'path', 'cycleway': 'path', 'steps': 'path', 'pedestrian': 'path',
+    'track': 'path', 'bridleway': 'path'
+}
+
+
+def way_style(tags):
+    """
+    Return the index into WAY_STYLES of a way with the given OSM tags.
+    """
+    if 'highway' in tags:
+        return WAY_STYLES.index(HIGHWAY_STYLES.get(tags['highway'], 'other'))
+    if 'building' in tags:
+        return WAY_STYLES.index('building')
+    return 0
+
+
+def iter_osm(source):
+    """
+    Incrementally parse OSM XML from a filename or file object, yielding
+    ('node', id, (lat, lon), tags) and ('way', id, [node ids], tags)
+    in document order. Only the keys in OSM_TAGS are kept in tags and
+    every element is discarded as soon as it has been read, so memory
+    doesn't grow with the size of the document.
+    """
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    root = None
+    for event, elem in context:
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == 'node':
+            yield ('node', elem.get('id'), (float(elem.get('lat')), float(elem.get('lon'))), _osm_tags(elem))
+        elif elem.tag == 'way':
+            yield ('way', elem.get('id'), [nd.get('ref') for nd in elem.iter('nd')], _osm_tags(elem))
+        elif elem.tag != 'relation':
+            continue
+        root.clear()
+
+
+def _osm_tags(elem):
+    tags = {}
+    for tag in elem.iter('tag'):
+        k = tag.get('k')
+        if k in OSM_TAGS:
+            tags[k] = tag.get('v')
+    return tags
+
+
+class NodeTable(object):
+    """
+    Node coordinates stored compactly as parallel arrays of int64 ids and
+    float64 (lat, lon) pairs, 24 bytes a node, instead of a dict of
+    tuples. Nodes are appended while parsing; freeze() then sorts them
+    by id so way refs are resolved by binary search.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.coords = numpy.empty((0, 2))
+        self._chunks = []
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._chunk_ids = numpy.empty(self.CHUNK_SIZE, dtype=numpy.int64)
+        self._chunk_coords = numpy.empty((self.CHUNK_SIZE, 2))
+        self._used = 0
+
+    def __len__(self):
+        return len(self.ids) + sum(len(ids) for ids, coords in self._chunks) + self._used
+
+    def append(self, node_id, lat, lon):
+        if self._used == self.CHUNK_SIZE:
+            self._chunks.append((self._chunk_ids, self._chunk_coords))
+            self._new_chunk()
+        self._chunk_ids[self._used] = node_id
+        self._chunk_coords[self._used] = (lat, lon)
+        self._used += 1
+
+    def freeze(self):
+        chunks = self._chunks + [(self._chunk_ids[:self._used], self._chunk_coords[:self._used])]
+        ids = numpy.concatenate([self.ids] + [chunk[0] for chunk in chunks])
+        coords = numpy.concatenate([self.coords] + [chunk[1] for chunk in chunks])
+        # the OSM API returns nodes in id order, so this is usually skipped
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            order = numpy.argsort(ids, kind='mergesort')
+            ids, coords = ids[order], coords[order]
+        self.ids, self.coords = ids, coords
+        self._chunks = []
+        self._new_chunk()
+
+    def resolve_ways(self, ways):
+        """
+        Turn (id, [node ids], style) ways into (id, (n, 2) array of (lat,
+        lon), style) with one vectorized lookup for all of their refs. Refs
+        to nodes that aren't in the table are dropped.
+        """
+        if not len(self.ids):
+            return [(way_id, numpy.empty((0, 2)), style) for way_id, refs, style in ways]
+        lengths = numpy.array([len(refs) for way_id, refs, style in ways], dtype=numpy.intp)
+        refs = numpy.array([ref for way_id, way_refs, style in ways for ref in way_refs], dtype=numpy.int64)
+        index = numpy.minimum(numpy.searchsorted(self.ids, refs), len(self.ids) - 1)
+        found = self.ids[index] == refs
+        points = numpy.split(self.coords[index], numpy.cumsum(lengths)[:-1])
+        found = numpy.split(found, numpy.cumsum(lengths)[:-1])
+        return [(way_id, way_points[way_found], style)
+                for (way_id, refs, style), way_points, way_found in zip(ways, points, found)]
+
+
+def parse_osm(source):
+    """
+    Parse OSM XML into (nodes, ways, tags) where nodes is a frozen
+    NodeTable, ways is a list of (id, [node ids], style) and tags maps
+    node id -> (lat, lon, name, amenity) for named amenities.
+    """
+    nodes = NodeTable()
     ways = []
-    tags = []
+    tags = {}
+    for kind, osm_id, value, osm_tags in iter_osm(source):
+        if kind == 'node':
+            nodes.append(int(osm_id), value[0], value[1])
+            # Named Amenities
+            if 'name' in osm_tags and 'amenity' in osm_tags:
+                tags[osm_id] = (value[0], value[1], osm_tags['name'], osm_tags['amenity'])
+        else:
+            ways.append((osm_id, [int(ref) for ref in value], way_style(osm_tags)))
+    nodes.freeze()
+    return nodes, ways, tags
+
+
+class MapFormatError(Exception):
+    pass
+
+
+class MapFile(object):
+    """
+    Read only view of a binary map file, memory mapped so its arrays are
+    zero-copy NumPy views of the file and nothing is parsed up front.
+
+    The file is a header followed by little endian arrays, each starting
+    8 byte aligned:
+
+        way_ids          int64[ways]
+        way_offsets      int64[ways + 1]   way i is points[offsets[i]:offsets[i + 1]]
+        tag_ids          int64[tags]
+        points           int32[points, 2]  (lat, lon) in units of 1e-7 degrees
+        tag_points       int32[tags, 2]
+        string_offsets   uint32[2 * tags + 1]
+        way_styles       uint8[ways]       index into WAY_STYLES
+        strings          UTF-8, the name then the amenity of each tag
+
+    Coordinates are fixed point rather than delta encoded so they can
+    be used in place without a decoding pass.
+    """
+    MAGIC = b'PBMAP\x00\x00\x02'
+    HEADER = struct.Struct('<8sqqq')
+    SCALE = 1e-7
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error), e:
+                raise MapFormatError("Can't map {0}: {1}".format(path, e))
+        if len(self._map) < self.HEADER.size:
+            raise MapFormatError("Truncated map file {0}".format(path))
+        magic, ways, points, tags = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC:
+            raise MapFormatError("Not a map file {0}".format(path))
+        self._position = self.HEADER.size
+        self.way_ids = self._array(numpy.int64, ways)
+        self.way_offsets = self._array(numpy.int64, ways + 1)
+        self.tag_ids = self._array(numpy.int64, tags)
+        self.points = self._array(numpy.int32, points * 2).reshape(-1, 2)
+        self.tag_points = self._array(numpy.int32, tags * 2).reshape(-1, 2)
+        self.string_offsets = self._array(numpy.uint32, tags * 2 + 1)
+        self.way_styles = self._array(numpy.uint8, ways)
+        self.strings = self._array(numpy.uint8, int(self.string_offsets[-1]))
+
+    def _array(self, dtype, count):
+        dtype = numpy.dtype(dtype).newbyteorder('<')
+        if self._position + dtype.itemsize * count > len(self._map):
+            raise MapFormatError("Truncated map file {0}".format(self.path))
+        array = numpy.frombuffer(self._map, dtype, count, self._position)
+        self._position += -(-dtype.itemsize * count // 8) * 8
+        return array
+
+    def close(self):
+        self._map.close()
+
+    def string(self, i):
+        start, stop = self.string_offsets[i], self.string_offsets[i + 1]
+        return self.strings[start:stop].tostring().decode('utf-8')
+
+    def ways(self):
+        """
+        Return the ways as a WayStore of (lat, lon) degrees, converted
+        from the file's arrays in one pass so nothing refers to the
+        mapped file once it's closed.
+        """
+        ways = WayStore()
+        ways.coords = self.points * self.SCALE
+        ways.offsets = self.way_offsets.astype(numpy.intp)
+        ways.styles = self.way_styles.copy()
+        ways.ids = self.way_ids.astype(numpy.int64)
+        short = numpy.diff(ways.offsets) < 2
+        if short.any():
+            ways = ways.subset(numpy.flatnonzero(~short))
+        return ways
+
+    def tags(self):
+        """
+        Return the tags as a dict of node id -> (lat, lon, name, amenity).
+        """
+        coords = (self.tag_points * self.SCALE).tolist()
+        return dict((str(tag_id), (coords[i][0], coords[i][1], self.string(2 * i), self.string(2 * i + 1)))
+                    for i, tag_id in enumerate(self.tag_ids.tolist()))
+
+
+def map_chunks(ways, tags):
+    """
+    Encode (id, [(lat, lon), ...], style) ways and a dict of node id ->
+    (lat, lon, name, amenity) tags as a MapFile, yielding it as byte
+    strings. Ways with fewer than two points are dropped.
+    """
+    ways = [(way_id, numpy.asarray(way, dtype=numpy.float64).reshape(-1, 2), style)
+            for way_id, way, style in ways if len(way) > 1]
+    tags = sorted(tags.items())
+    lengths = numpy.array([len(way) for way_id, way, style in ways], dtype=numpy.int64)
+    offsets = numpy.zeros(len(ways) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    points = numpy.concatenate([way for way_id, way, style in ways]) if ways else numpy.empty((0, 2))
+    strings = []
+    for tag_id, tag in tags:
+        for text in tag[2:4]:
+            strings.append(text.encode('utf-8') if not isinstance(text, bytes) else text)
+    string_offsets = numpy.zeros(len(strings) + 1, dtype=numpy.uint32)
+    numpy.cumsum([len(text) for text in strings], out=string_offsets[1:])
+
+    def fixed(coords):
+        return numpy.round(numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2) / MapFile.SCALE)
+
+    yield MapFile.HEADER.pack(MapFile.MAGIC, len(ways), len(points), len(tags))
+    for array, dtype in ((numpy.array([int(way_id) for way_id, way, style in ways]), '<i8'),
+                         (offsets, '<i8'),
+                         (numpy.array([int(tag_id) for tag_id, tag in tags]), '<i8'),
+                         (fixed(points), '<i4'),
+                         (fixed([tag[:2] for tag_id, tag in tags]), '<i4'),
+                         (string_offsets, '<u4'),
+                         (numpy.array([style for way_id, way, style in ways]), 'u1')):
+        data = numpy.asarray(array).astype(dtype).tostring()
+        yield data + b'\x00' * (-len(data) % 8)
+    yield b''.join(strings)
+
+
+class MapDatabase(object):
+    """
+    Indexed on-device map store built from a local .osm extract, so maps
+    work without connectivity. Ways are stored with their resolved
+    geometry and bounding box, and ways and tags are both bucketed on
+    a BUCKET_SIZE degree grid so a bbox query only touches the buckets
+    it overlaps.
+    """
+    BUCKET_SIZE = 0.005
+    BATCH_SIZE = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+        CREATE TABLE IF NOT EXISTS ways (
+            id INTEGER PRIMARY KEY,
+            min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+            points BLOB, style INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS way_buckets (bx INTEGER, by INTEGER, way_id INTEGER);
+        CREATE INDEX IF NOT EXISTS way_buckets_xy ON way_buckets (bx, by);
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            lat REAL, lon REAL, name TEXT, amenity TEXT,
+            bx INTEGER, by INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS tags_xy ON tags (bx, by);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        # sqlite connections can't be shared between the fetch threads
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.path)
+            self._local.connection.executescript(self.SCHEMA)
+            columns = [row[1] for row in self._local.connection.execute("PRAGMA table_info(ways)")]
+            if 'style' not in columns:
+                # imported before ways were styled; they all draw as 'other' until reimported
+                self._local.connection.execute("ALTER TABLE ways ADD COLUMN style INTEGER DEFAULT 0")
+        return self._local.connection
+
+    def bucket(self, lon, lat):
+        return int(math.floor(lon / self.BUCKET_SIZE)), int(math.floor(lat / self.BUCKET_SIZE))
+
+    def coverage(self):
+        """
+        Return the (min lon, min lat, max lon, max lat) of the imported
+        extract, or None if nothing has been imported.
+        """
+        rows = dict(self.connection().execute("SELECT key, value FROM meta"))
+        if 'min_lon' not in rows:
+            return None
+        return rows['min_lon'], rows['min_lat'], rows['max_lon'], rows['max_lat']
+
+    def covers(self, bounds):
+        coverage = self.coverage()
+        return coverage is not None and (
+            coverage[0] <= bounds[0] and coverage[1] <= bounds[1] and
+            coverage[2] >= bounds[2] and coverage[3] >= bounds[3])
+
+    def import_osm(self, source):
+        """
+        Import a .osm XML extract, replacing anything imported before.
+        Nodes are staged in a temporary table rather than in memory so
+        extracts much larger than RAM can be imported. It all happens in
+        one transaction, so a failed import leaves the old data in place.
+        """
+        db = self.connection()
+        # executescript would commit, so the deletes go through execute to stay in the transaction
+        db.execute("DROP TABLE IF EXISTS temp.import_nodes")
+        db.execute("CREATE TEMP TABLE import_nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL)")
+        with db:
+            for table in ('meta', 'ways', 'way_buckets', 'tags'):
+                db.execute("DELETE FROM %s" % table)
+            nodes = []
+            tags = []
+            low = [180.0, 90.0]
+            high = [-180.0, -90.0]
+            ways = 0
+            for kind, osm_id, value, osm_tags in iter_osm(source):
+                if kind == 'node':
+                    lat, lon = value
+                    nodes.append((int(osm_id), lat, lon))
+                    low = [min(low[0], lon), min(low[1], lat)]
+                    high = [max(high[0], lon), max(high[1], lat)]
+                    if 'name' in osm_tags and 'amenity' in osm_tags:
+                        tags.append((int(osm_id), lat, lon, osm_tags['name'], osm_tags['amenity']) +
+                                    self.bucket(lon, lat))
+                    if len(nodes) >= self.BATCH_SIZE:
+                        self._flush(db, nodes, tags)
+                else:
+                    self._flush(db, nodes, tags)
+                    if self._import_way(db, int(osm_id), [int(ref) for ref in value], way_style(osm_tags)):
+                        ways += 1
+            self._flush(db, nodes, tags)
+            db.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('min_lon', low[0]), ('min_lat', low[1]), ('max_lon', high[0]), ('max_lat', high[1])
+            ])
+        db.execute("DROP TABLE import_nodes")
+        logging.info("[Imported %d ways into %s]" % (ways, self.path))
+        return ways
+
+    def _flush(self, db, nodes, tags):
+        db.executemany("INSERT OR REPLACE INTO import_nodes VALUES (?, ?, ?)", nodes)
+        db.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)", tags)
+        del nodes[:]
+        del tags[:]
+
+    def _import_way(self, db, way_id, refs, style):
+        found = {}
+        # stay under sqlite's limit on bound parameters
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            found.update((row[0], row[1:]) for row in db.execute(
+                "SELECT id, lat, lon FROM import_nodes WHERE id IN (%s)" % ','.join('?' * len(chunk)), chunk))
+        points = numpy.array([found[ref] for ref in refs if ref in found], dtype=numpy.float64)
+        if len(points) < 2:
+            return False
+        min_lat, min_lon = points.min(0)
+        max_lat, max_lon = points.max(0)
+        db.execute("INSERT OR REPLACE INTO ways VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            way_id, min_lon, min_lat, max_lon, max_lat, sqlite3.Binary(points.tostring()), style))
+        x0, y0 = self.bucket(min_lon, min_lat)
+        x1, y1 = self.bucket(max_lon, max_lat)
+        db.executemany("INSERT INTO way_buckets VALUES (?, ?, ?)", [
+            (x, y, way_id) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)])
+        return True
+
+    def query(self, bounds):
+        """
+        Return the ways and tags overlapping (min lon, min lat, max lon,
+        max lat) bounds in the form MapStore.add_tile takes them.
+        """
+        db = self.connection()
+        x0, y0 = self.bucket(bounds[0], bounds[1])
+        x1, y1 = self.bucket(bounds[2], bounds[3])
+        ways = [(str(row[0]), numpy.frombuffer(row[1], dtype=numpy.float64).reshape(-1, 2), row[2]) for row in db.execute("""
+            SELECT id, points, style FROM ways
+            WHERE id IN (SELECT way_id FROM way_buckets WHERE bx BETWEEN ? AND ? AND by BETWEEN ? AND ?)
+            AND min_lon <= ? AND max_lon >= ? AND min_lat <= ? AND max_lat >= ?
+        """, (x0, x1, y0, y1, bounds[2], bounds[0], bounds[3], bounds[1]))]
+        tags = dict((str(row[0]), tuple(row[1:])) for row in db.execute("""
+            SELECT id, lat, lon, name, amenity FROM tags
+            WHERE bx BETWEEN ? AND ? AND by BETWEEN ? AND ?
+            AND lon BETWEEN ? AND ? AND lat BETWEEN ? AND ?
+        """, (x0, x1, y0, y1, bounds[0], bounds[2], bounds[1], bounds[3])))
+        return ways, tags
+
+
+def douglas_peucker(coords, offsets, tolerance):
+    """
+    Douglas-Peucker simplify every way in a flat coords/offsets buffer at
+    once, returning a mask of the points to keep. Each pass splits every
+    open segment of every way at its furthest point, so the number of
+    passes follows the recursion depth rather than the number of ways.
+    The first and last point of each way are always kept.
+    """
+    keep = numpy.zeros(len(coords), dtype=bool)
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    keep[first] = True
+    keep[last] = True
+    open_segments = last - first > 1
+    first, last = first[open_segments], last[open_segments]
+    while len(first):
+        # every interior point of every open segment, with its segment number
+        lengths = last - first - 1
+        starts = numpy.zeros(len(first) + 1, dtype=numpy.intp)
+        numpy.cumsum(lengths, out=starts[1:])
+        segment = numpy.repeat(numpy.arange(len(first)), lengths)
+        interior = numpy.repeat(first + 1 - starts[:-1], lengths) + numpy.arange(starts[-1])
+        origin = coords[first][segment]
+        direction = coords[last][segment] - origin
+        between = coords[interior] - origin
+        length = numpy.hypot(direction[:, 0], direction[:, 1])
+        cross = numpy.abs(direction[:, 0] * between[:, 1] - direction[:, 1] * between[:, 0])
+        distances = numpy.where(length > 0, cross / numpy.where(length > 0, length, 1),
+                                numpy.hypot(between[:, 0], between[:, 1]))
+        furthest = numpy.maximum.reduceat(distances, starts[:-1])
+        candidates = numpy.nonzero(distances == furthest[segment])[0]
+        unique_segments, index = numpy.unique(segment[candidates], return_index=True)
+        split = interior[candidates[index]]
+        needs_split = furthest > tolerance
+        split = split[needs_split]
+        keep[split] = True
+        first = numpy.concatenate((first[needs_split], split))
+        last = numpy.concatenate((split, last[needs_split]))
+        open_segments = last - first > 1
+        first, last = first[open_segments], last[open_segments]
+    return keep
+
+
+class WayStore(object):
+    """
+    Way geometry kept as one flat (n, 2) array of (lat, lon) points plus
+    an offsets index: way i is coords[offsets[i]:offsets[i + 1]].
+    levels holds simplified copies of the same ways, coarsest last,
+    as (tolerance in degrees, WayStore) pairs. styles holds each way's
+    index into WAY_STYLES and ids its OSM id.
+    """
+
+    def __init__(self):
+        self.coords = numpy.empty((0, 2))
+        self.offsets = numpy.zeros(1, dtype=numpy.intp)
+        self.styles = numpy.zeros(0, dtype=numpy.uint8)
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.levels = []
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.split(self.coords))
+
+    def extend(self, ways, styles=None, ids=None):
+        """
+        Append a batch of ways, each a sequence of (lat, lon) points, and
+        optionally their styles and ids. Ways with fewer than two points
+        can't be drawn and are dropped.
+        """
+        if styles is None:
+            styles = [0] * len(ways)
+        if ids is None:
+            ids = [0] * len(ways)
+        kept = [(numpy.asarray(way, dtype=numpy.float64), style, way_id)
+                for way, style, way_id in zip(ways, styles, ids) if len(way) > 1]
+        if not kept:
+            return
+        lengths = numpy.array([len(way) for way, style, way_id in kept], dtype=numpy.intp)
+        points = numpy.concatenate([way for way, style, way_id in kept])
+        self.coords = numpy.concatenate((self.coords, points))
+        self.offsets = numpy.concatenate((self.offsets, self.offsets[-1] + numpy.cumsum(lengths)))
+        self.styles = numpy.concatenate((self.styles, numpy.array([style for way, style, way_id in kept], dtype=numpy.uint8)))
+        self.ids = numpy.concatenate((self.ids, numpy.array([way_id for way, style, way_id in kept], dtype=numpy.int64)))
+        self.levels = []
+
+    @staticmethod
+    def concatenate(stores):
+        """
+        Join WayStores whose levels were built with the same tolerances
+        into one, levels and all.
+        """
+        stores = [store for store in stores if len(store)]
+        ways = WayStore()
+        if not stores:
+            return ways
+        ways.coords = numpy.concatenate([store.coords for store in stores])
+        starts = numpy.cumsum([0] + [len(store.coords) for store in stores[:-1]])
+        ways.offsets = numpy.concatenate([stores[0].offsets[:1]] + [
+            store.offsets[1:] + start for store, start in zip(stores, starts)])
+        ways.styles = numpy.concatenate([store.styles for store in stores])
+        ways.ids = numpy.concatenate([store.ids for store in stores])
+        ways.levels = [(tolerance, WayStore.concatenate([store.levels[i][1] for store in stores]))
+                       for i, (tolerance, level) in enumerate(stores[0].levels)]
+        return ways
+
+    def subset(self, indices):
+        """
+        Return a WayStore of just the given ways, in that order, levels
+        and all.
+        """
+        ways = WayStore()
+        ways.coords, ways.offsets = self.select(indices)
+        ways.styles = self.styles[indices]
+        ways.ids = self.ids[indices]
+        ways.levels = [(tolerance, level.subset(indices)) for tolerance, level in self.levels]
+        return ways
+
+    def build_levels(self, tolerances):
+        """
+        Precompute a Douglas-Peucker simplified copy of every way for each
+        tolerance. Each level is simplified from the one before it, which
+        is much cheaper than starting from the full geometry every time.
+        """
+        levels = []
+        source = self
+        for tolerance in sorted(tolerances):
+            if not len(self):
+                break
+            keep = douglas_peucker(source.coords, source.offsets, tolerance)
+            level = WayStore()
+            level.coords = source.coords[keep]
+            level.styles = self.styles
+            level.ids = self.ids
+            level.offsets = numpy.zeros_like(source.offsets)
+            numpy.cumsum(numpy.add.reduceat(keep, source.offsets[:-1]), out=level.offsets[1:])
+            levels.append((tolerance, level))
+            source = level
+        self.levels = levels
+
+    def level(self, scale, pixels=1.0):
+        """
+        Return the coarsest level whose error stays under pixels at scale
+        pixels per degree, or self if none of them do.
+        """
+        best = self
+        for tolerance, level in self.levels:
+            if tolerance * max(abs(scale[0]), abs(scale[1])) > pixels:
+                break
+            best = level
+        return best
+
+    def split(self, points, offsets=None):
+        """
+        Split an array parallel to coords into per-way views.
+        """
+        if offsets is None:
+            offsets = self.offsets
+        return numpy.split(points, offsets[1:-1]) if len(offsets) > 1 else []
+
+    def bounds(self):
+        """
+        Return an (n, 4) array of (min lon, min lat, max lon, max lat)
+        boxes, one per way.
+        """
+        if not len(self):
+            return numpy.empty((0, 4))
+        starts = self.offsets[:-1]
+        low = numpy.minimum.reduceat(self.coords, starts)
+        high = numpy.maximum.reduceat(self.coords, starts)
+        return numpy.column_stack((low[:, 1], low[:, 0], high[:, 1], high[:, 0]))
+
+    def select(self, indices):
+        """
+        Return (points, offsets) for just the given ways.
+        """
+        starts = self.offsets[:-1][indices]
+        lengths = self.offsets[1:][indices] - starts
+        offsets = numpy.zeros(len(indices) + 1, dtype=numpy.intp)
+        numpy.cumsum(lengths, out=offsets[1:])
+        # index of every selected point: a run of aranges, one per way
+        points = numpy.repeat(starts - offsets[:-1], lengths) + numpy.arange(offsets[-1])
+        return self.coords[points], offsets
+
+    def transpose(self, origin, scale, offset, flip_y=True, indices=None, lod=True):
+        """
+        Project points to screen space in one affine operation and return
+        per-way views of the result. origin is (lon, lat), scale the
+        pixels per degree along each axis. If indices is given only those
+        ways are projected. With lod the coarsest precomputed level that
+        is still accurate to a pixel at this scale is used.
+        """
+        store = self.level(scale) if lod else self
+        if indices is None:
+            coords, offsets = store.coords, store.offsets
+        else:
+            coords, offsets = store.select(indices)
+        points = numpy.empty_like(coords)
+        points[:, 0] = (coords[:, 1] - origin[0]) * scale[0] + offset[0]
+        if flip_y:
+            points[:, 1] = (origin[1] - coords[:, 0]) * scale[1] + offset[1]
+        else:
+            points[:, 1] = (coords[:, 0] - origin[1]) * scale[1] + offset[1]
+        return self.split(points, offsets)
+
+    def draw_lists(self, origin, scale, offset, flip_y=True, indices=None, lod=True):
+        """
+        Project ways like transpose, grouped into (style name, [ways])
+        batches in WAY_STYLES order so each style can be drawn in one
+        loop with one colour and width.
+        """
+        if indices is None:
+            indices = numpy.arange(len(self))
+        styles = self.styles[indices]
+        # stable, and nearly free when the ways are already stored by style
+        order = numpy.argsort(styles, kind='mergesort')
+        styles = styles[order]
+        ways = self.transpose(origin, scale, offset, flip_y, numpy.asarray(indices)[order], lod)
+        lists = []
+        starts = [0] + (numpy.flatnonzero(numpy.diff(styles)) + 1).tolist()
+        for start, stop in zip(starts, starts[1:] + [len(styles)]):
+            if stop > start:
+                lists.append((WAY_STYLES[styles[start]], ways[start:stop]))
+        return lists
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid over item bounding boxes, answering which items
+    overlap a query rectangle without looking at every item.
+    Boxes are (min x, min y, max x, max y).
+    """
+    CELLS = 32
+
+    def __init__(self, boxes):
+        self.boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        self._cells = {}
+        if not len(self.boxes):
+            self.origin = (0, 0)
+            self.cell_size = 1
+            return
+        self.origin = (self.boxes[:, 0].min(), self.boxes[:, 1].min())
+        span = max(self.boxes[:, 2].max() - self.origin[0], self.boxes[:, 3].max() - self.origin[1])
+        self.cell_size = (span / self.CELLS) or 1
+        # every (item, cell) pair at once, grouped by cell
+        x0, y0, x1, y1 = self._cell_range(self.boxes).T
+        heights = y1 - y0 + 1
+        counts = (x1 - x0 + 1) * heights
+        items = numpy.repeat(numpy.arange(len(self.boxes)), counts)
+        starts = numpy.cumsum(counts) - counts
+        within = numpy.arange(len(items)) - numpy.repeat(starts, counts)
+        cells = self._cell_id(x0[items] + within // heights[items], y0[items] + within % heights[items])
+        order = numpy.argsort(cells, kind='mergesort')
+        cells, items = cells[order], items[order]
+        first = numpy.flatnonzero(numpy.concatenate(([True], cells[1:] != cells[:-1])))
+        self._cells = dict(zip(cells[first].tolist(), numpy.split(items, first[1:])))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _cell_id(self, x, y):
+        # cell ranges are clipped to -1 .. CELLS + 1
+        return (x + 1) * (self.CELLS + 3) + y + 1
+
+    def _cell_range(self, boxes):
+        cells = numpy.empty(boxes.shape, dtype=numpy.int64)
+        cells[:, 0::2] = numpy.floor((boxes[:, 0::2] - self.origin[0]) / self.cell_size)
+        cells[:, 1::2] = numpy.floor((boxes[:, 1::2] - self.origin[1]) / self.cell_size)
+        return numpy.clip(cells, -1, self.CELLS + 1)
+
+    def query(self, bounds):
+        """
+        Return the sorted indices of items whose box overlaps bounds.
+        """
+        if not len(self.boxes):
+            return numpy.empty(0, dtype=numpy.intp)
+        x0, y0, x1, y1 = self._cell_range(numpy.array([bounds], dtype=numpy.float64))[0].tolist()
+        found = [self._cells[cell] for cell in (self._cell_id(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+                 if cell in self._cells]
+        if not found:
+            return numpy.empty(0, dtype=numpy.intp)
+        candidates = numpy.unique(numpy.concatenate(found))
+        boxes = self.boxes[candidates]
+        hit = ((boxes[:, 0] <= bounds[2]) & (boxes[:, 2] >= bounds[0]) &
+               (boxes[:, 1] <= bounds[3]) & (boxes[:, 3] >= bounds[1]))
+        return candidates[hit]
+
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(a, b):
+    """
+    Great circle distance in metres between two (lat, lon) points.
+    """
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def unit_vectors(points):
+    """
+    Map an (n, 2) array of (lat, lon) onto (n, 3) points on the unit
+    sphere, where straight line distance orders points the same way as
+    great circle distance.
+    """
+    points = numpy.radians(numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2))
+    cos_lat = numpy.cos(points[:, 0])
+    return numpy.column_stack((cos_lat * numpy.cos(points[:, 1]), cos_lat * numpy.sin(points[:, 1]), numpy.sin(points[:, 0])))
+
+
+def chord_to_metres(chord):
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(chord / 2, 1.0))
+
+
+def metres_to_chord(metres):
+    return 2 * math.sin(min(metres / EARTH_RADIUS, math.pi) / 2)
+
+
+class KDTree(object):
+    """
+    Static KD-tree over unit sphere points, split on the widest axis at
+    the median. Each point carries a serial number that KDForest uses to
+    tell live points from removed ones.
+    """
+    LEAF_SIZE = 16
+
+    def __init__(self, points, serials):
+        self.points = numpy.array(points, dtype=numpy.float64)
+        self.serials = numpy.array(serials, dtype=numpy.intp)
+        # (start, stop, mins, maxs, left, right) with -1 children at leaves
+        self.nodes = []
+        if len(self.points):
+            self._build(0, len(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, start, stop):
+        points = self.points[start:stop]
+        mins, maxs = points.min(axis=0), points.max(axis=0)
+        node = len(self.nodes)
+        self.nodes.append(None)
+        if stop - start <= self.LEAF_SIZE:
+            self.nodes[node] = (start, stop, mins, maxs, -1, -1)
+            return node
+        mid = (start + stop) // 2
+        order = numpy.argpartition(points[:, numpy.argmax(maxs - mins)], mid - start)
+        self.points[start:stop] = points[order]
+        self.serials[start:stop] = self.serials[start:stop][order]
+        left = self._build(start, mid)
+        right = self._build(mid, stop)
+        self.nodes[node] = (start, stop, mins, maxs, left, right)
+        return node
+
+    def search(self, point, alive, bound, visit):
+        """
+        Visit the leaves that may hold points within sqrt(bound()) of
+        point, nearest first, calling visit(squared distances, serials)
+        with the live points of each. bound is called again after every
+        visit so k nearest searches can shrink it as they go.
+        """
+        if not self.nodes:
+            return
+        pending = [(0.0, 0)]
+        while pending:
+            distance, node = heapq.heappop(pending)
+            if distance > bound():
+                break
+            start, stop, mins, maxs, left, right = self.nodes[node]
+            if left < 0:
+                serials = self.serials[start:stop]
+                live = alive[serials]
+                if live.any():
+                    offsets = self.points[start:stop][live] - point
+                    visit((offsets * offsets).sum(axis=1), serials[live])
+                continue
+            for child in (left, right):
+                child_mins, child_maxs = self.nodes[child][2:4]
+                gap = numpy.maximum(numpy.maximum(child_mins - point, point - child_maxs), 0.0)
+                heapq.heappush(pending, (float((gap * gap).sum()), child))
+
+
+class KDForest(object):
+    """
+    Incrementally built nearest neighbour index over (lat, lon) points
+    keyed by id. Points are added to a small buffer that is searched
+    linearly; once it fills it's merged with every tree no bigger than
+    it into one new static KDTree, keeping O(log n) trees of doubling
+    size. Removed points are masked out until they outnumber the live
+    ones, when the whole forest is rebuilt.
+    """
+    BUFFER_SIZE = 64
+
+    def __init__(self):
+        self.trees = []
+        self._ids = []
+        self._serials = {}
+        self._alive = numpy.zeros(self.BUFFER_SIZE, dtype=bool)
+        self._buffer_points = []
+        self._buffer_serials = []
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._serials)
+
+    def add(self, point_id, point):
+        if point_id in self._serials:
+            self.remove(point_id)
+        serial = len(self._ids)
+        self._ids.append(point_id)
+        self._serials[point_id] = serial
+        if serial >= len(self._alive):
+            self._alive = numpy.concatenate((self._alive, numpy.zeros(len(self._alive), dtype=bool)))
+        self._alive[serial] = True
+        self._buffer_points.append(unit_vectors(point)[0])
+        self._buffer_serials.append(serial)
+        if len(self._buffer_serials) >= self.BUFFER_SIZE:
+            self._merge()
+
+    def remove(self, point_id):
+        self._alive[self._serials.pop(point_id)] = False
+        self._dead += 1
+        if self._dead > max(len(self._serials), self.BUFFER_SIZE):
+            self._rebuild()
+
+    def _merge(self):
+        points = [numpy.array(self._buffer_points).reshape(-1, 3)]
+        serials = [numpy.array(self._buffer_serials, dtype=numpy.intp)]
+        size = len(self._buffer_serials)
+        while self.trees and len(self.trees[-1]) <= size:
+            tree = self.trees.pop()
+            points.append(tree.points)
+            serials.append(tree.serials)
+            size += len(tree)
+        self.trees.append(KDTree(numpy.concatenate(points), numpy.concatenate(serials)))
+        self._buffer_points = []
+        self._buffer_serials = []
+
+    def _rebuild(self):
+        points = [tree.points for tree in self.trees] + [numpy.array(self._buffer_points).reshape(-1, 3)]
+        serials = [tree.serials for tree in self.trees] + [numpy.array(self._buffer_serials, dtype=numpy.intp)]
+        points, serials = numpy.concatenate(points), numpy.concatenate(serials)
+        live = self._alive[serials]
+        points, serials = points[live], serials[live]
+        ids = [self._ids[serial] for serial in serials]
+        self._ids = ids
+        self._serials = dict((point_id, serial) for serial, point_id in enumerate(ids))
+        self._alive = numpy.ones(max(len(ids), self.BUFFER_SIZE), dtype=bool)
+        self._alive[len(ids):] = False
+        self._buffer_points = []
+        self._buffer_serials = []
+        self._dead = 0
+        self.trees = [KDTree(points, numpy.arange(len(ids)))] if len(ids) else []
+
+    def _search(self, point, bound, visit):
+        point = unit_vectors(point)[0]
+        if self._buffer_serials:
+            serials = numpy.array(self._buffer_serials, dtype=numpy.intp)
+            live = self._alive[serials]
+            offsets = numpy.array(self._buffer_points)[live] - point
+            visit((offsets * offsets).sum(axis=1), serials[live])
+        for tree in self.trees:
+            tree.search(point, self._alive, bound, visit)
+
+    def nearest(self, point, k, max_distance=None):
+        """
+        Return up to k (metres, id) pairs for the points nearest to a
+        (lat, lon) point, nearest first, no further than max_distance
+        metres if that's given.
+        """
+        limit = float('inf') if max_distance is None else metres_to_chord(max_distance) ** 2
+        best = []
+
+        def bound():
+            return -best[0][0] if len(best) == k else limit
+
+        def visit(distances, serials):
+            for distance, serial in zip(distances.tolist(), serials.tolist()):
+                if distance > bound():
+                    continue
+                if len(best) == k:
+                    heapq.heapreplace(best, (-distance, serial))
+                else:
+                    heapq.heappush(best, (-distance, serial))
+
+        if k > 0:
+            self._search(point, bound, visit)
+        best = sorted((-distance, serial) for distance, serial in best)
+        distances = chord_to_metres(numpy.sqrt([distance for distance, serial in best]))
+        return [(metres, self._ids[serial]) for metres, (distance, serial) in zip(distances.tolist(), best)]
+
+    def within(self, point, radius):
+        """
+        Return (metres, id) pairs for every point within radius metres of
+        a (lat, lon) point, nearest first.
+        """
+        limit = metres_to_chord(radius) ** 2
+        found = []
+
+        def visit(distances, serials):
+            inside = distances <= limit
+            found.extend(zip(distances[inside].tolist(), serials[inside].tolist()))
+
+        self._search(point, lambda: limit, visit)
+        found.sort()
+        distances = chord_to_metres(numpy.sqrt([distance for distance, serial in found]))
+        return [(metres, self._ids[serial]) for metres, (distance, serial) in zip(distances.tolist(), found)]
+
+
+class PoiIndex(object):
+    """
+    Named amenities indexed by name and by amenity: a sorted list of
+    (lowercased name, id) pairs answers prefix queries by binary search
+    and an amenity -> ids inverted index answers amenity filters, so
+    neither needs a scan of every tag. A KDForest of all of them and one
+    per amenity answer nearest and radius queries.
+    """
+
+    def __init__(self):
+        self._names = []
+        self._amenities = {}
+        self._tags = {}
+        self._forests = {None: KDForest()}
+
+    def __len__(self):
+        return len(self._tags)
+
+    def add(self, tag_id, tag):
+        if tag_id in self._tags:
+            self.remove(tag_id)
+        self._tags[tag_id] = tag
+        bisect.insort(self._names, (tag[2].lower(), tag_id))
+        self._amenities.setdefault(tag[3], set()).add(tag_id)
+        if tag[3] not in self._forests:
+            self._forests[tag[3]] = KDForest()
+        for amenity in (None, tag[3]):
+            self._forests[amenity].add(tag_id, tag[:2])
+
+    def remove(self, tag_id):
+        tag = self._tags.pop(tag_id)
+        del self._names[bisect.bisect_left(self._names, (tag[2].lower(), tag_id))]
+        ids = self._amenities[tag[3]]
+        ids.discard(tag_id)
+        if not ids:
+            del self._amenities[tag[3]]
+            del self._forests[tag[3]]
+        else:
+            self._forests[tag[3]].remove(tag_id)
+        self._forests[None].remove(tag_id)
+
+    def nearest(self, near, k, amenity=None, max_distance=None):
+        """
+        Return up to k (metres, tag) pairs for the tags nearest to a
+        (lat, lon) near point, of one amenity if that's given.
+        """
+        forest = self._forests.get(amenity)
+        if forest is None:
+            return []
+        return [(metres, self._tags[tag_id]) for metres, tag_id in forest.nearest(near, k, max_distance)]
+
+    def within(self, near, radius, amenity=None):
+        """
+        Return (metres, tag) pairs for every tag within radius metres of
+        a (lat, lon) near point, of one amenity if that's given.
+        """
+        forest = self._forests.get(amenity)
+        if forest is None:
+            return []
+        return [(metres, self._tags[tag_id]) for metres, tag_id in forest.within(near, radius)]
+
+    def find(self, prefix='', amenity=None, near=None, limit=10):
+        """
+        Return up to limit (lat, lon, name, amenity) tags whose name
+        starts with prefix, ignoring case, and whose amenity matches if
+        one is given. They're ordered by distance from a (lat, lon)
+        near point if one is given, by name otherwise.
+        """
+        prefix = prefix.lower()
+        if not prefix and near is not None:
+            return [tag for metres, tag in self.nearest(near, limit, amenity)]
+        if prefix or amenity is None:
+            start = bisect.bisect_left(self._names, (prefix,))
+            stop = bisect.bisect_left(self._names, (prefix + u'\uffff',))
+            ids = [tag_id for name, tag_id in self._names[start:stop]]
+            if amenity is not None:
+                members = self._amenities.get(amenity, ())
+                ids = [tag_id for tag_id in ids if tag_id in members]
+            tags = [self._tags[tag_id] for tag_id in ids]
+        else:
+            tags = [self._tags[tag_id] for tag_id in self._amenities.get(amenity, ())]
+            if near is None:
+                tags.sort(key=lambda tag: tag[2].lower())
+        if near is not None:
+            return heapq.nsmallest(limit, tags, key=lambda tag: haversine(near, tag))
+        return tags[:limit]
+
+
+class MapStore(object):
+    """
+    Parsed map data shared by every Maps instance, a WayStore and the
+    tags of each tile. Tags are kept once per OSM id however many tiles
+    reference them; a way crossing tiles is held by each of them and
+    handed out once. Tiles are evicted least recently used first once
+    more than max_points way points are held, dropping tags no other
+    tile still uses.
+    """
+
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.points = 0
+        self._tags = {}
+        self._tiles = OrderedDict()
+        self._lock = threading.RLock()
+        self.pois = PoiIndex()
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def add_tile(self, key, ways, tags, version=None):
+        """
+        Store a tile given its ways as a WayStore, built ready for
+        drawing by the thread that fetched it, and its tags as a dict of
+        node id -> (lat, lon, name, amenity). version identifies the
+        data, such as when it was fetched, so anything drawn from it can
+        tell when it has been replaced.
+        """
+        with self._lock:
+            if key in self._tiles:
+                self._release(key)
+            for tag_id, tag in tags.items():
+                if tag_id in self._tags:
+                    self._tags[tag_id][1] += 1
+                else:
+                    self._tags[tag_id] = [tag, 1]
+                    self.pois.add(tag_id, tag)
+            self._tiles[key] = (ways, list(tags.keys()), version)
+            self.points += len(ways.coords)
+            while self.points > self.max_points and len(self._tiles) > 1:
+                evicted = next(iter(self._tiles))
+                self._release(evicted)
+                logging.info("[Map store evicted %s]" % evicted)
+
+    def tiles(self, keys):
+        """
+        Return (WayStore, [tags]) for the stored tiles among keys, each
+        way and tag appearing once however many of them share it.
+        """
+        with self._lock:
+            blocks = []
+            tag_ids = OrderedDict()
+            for key in keys:
+                if key not in self._tiles:
+                    continue
+                tile = self._tiles.pop(key)
+                self._tiles[key] = tile
+                blocks.append(tile[0])
+                tag_ids.update((tag_id, True) for tag_id in tile[1])
+            tags = [self._tags[tag_id][0] for tag_id in tag_ids]
+        ways = WayStore.concatenate(blocks)
+        # the first copy of each way, in tile order
+        ids, first = numpy.unique(ways.ids, return_index=True)
+        if len(first) < len(ways):
+            ways = ways.subset(numpy.sort(first))
+        return ways, tags
+
+    def version(self, key):
+        """
+        Return the version a stored tile was added with, or None.
+        """
+        tile = self._tiles.get(key)
+        return tile[2] if tile is not None else None
+
+    def find_poi(self, prefix='', amenity=None, near=None, limit=10):
+        """
+        Search the stored tags, see PoiIndex.find.
+        """
+        with self._lock:
+            return self.pois.find(prefix, amenity, near, limit)
+
+    def nearest_poi(self, near, k, amenity=None, max_distance=None):
+        """
+        Return up to k (metres, tag) pairs nearest to near, see PoiIndex.nearest.
+        """
+        with self._lock:
+            return self.pois.nearest(near, k, amenity, max_distance)
+
+    def pois_within(self, near, radius, amenity=None):
+        """
+        Return (metres, tag) pairs within radius of near, see PoiIndex.within.
+        """
+        with self._lock:
+            return self.pois.within(near, radius, amenity)
+
+    def _release(self, key):
+        ways, tag_ids, version = self._tiles.pop(key)
+        self.points -= len(ways.coords)
+        for tag_id in tag_ids:
+            entry = self._tags[tag_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._tags[tag_id]
+                self.pois.remove(tag_id)
+
+
+class FetchJob(object):
+    def __init__(self, priority, function, args):
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FetchScheduler(object):
+    """
+    Runs map fetches on a fixed pool of worker threads, lowest priority
+    value first. Jobs cancelled before a worker picks them up are skipped.
+    Jobs submitted with the same key, such as two views wanting the same
+    tile, run one after another on one worker, so the first fetches it
+    and the rest find it already stored.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = queue.PriorityQueue()
+        self._sequence = 0
+        self._threads = []
+        self._keyed = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, function, args=(), priority=0, key=None):
+        job = FetchJob(priority, function, args)
+        with self._lock:
+            if key is None:
+                jobs = [job]
+            else:
+                jobs = self._keyed.setdefault(key, [])
+                jobs.append(job)
+            # the sequence number keeps equal priorities first in, first out;
+            # a keyed batch queued more than once runs at its best priority
+            self._sequence += 1
+            self._queue.put((priority, self._sequence, key, jobs))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return job
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            priority, sequence, key, jobs = self._queue.get()
+            with self._lock:
+                # already being worked through by another worker, or done
+                if key is not None and (key in self._running or self._keyed.get(key) is not jobs):
+                    continue
+                self._running.add(key)
+            while True:
+                with self._lock:
+                    if not jobs:
+                        # jobs for key submitted from now on start a new batch
+                        self._running.discard(key)
+                        if key is not None:
+                            del self._keyed[key]
+                        break
+                    job = jobs.pop(0)
+                if job.cancelled:
+                    continue
+                try:
+                    job.function(*job.args)
+                except Exception:
+                    logging.error(traceback.format_exc())
+
+
+# Latitude where the square Web-Mercator world ends
+MERCATOR_MAX_LAT = 85.0511287798
+
+
+def mercator_y(lat):
+    """
+    Web-Mercator y of a latitude, or an array of them, in degrees so it
+    shares units with longitude. Map views work in (lon, mercator_y)
+    where the z/x/y tile pyramid is a regular grid.
+    """
+    lat = numpy.radians(numpy.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    return numpy.degrees(numpy.log(numpy.tan(numpy.pi / 4 + lat / 2)))
+
+
+def mercator_lat(y):
+    return math.degrees(2 * math.atan(math.exp(math.radians(y))) - math.pi / 2)
+
+
+def tile_key(tile):
+    return "%d_%d_%d" % tile
+
+
+def tile_extent(tile):
+    """
+    Return (min lon, min y, max lon, max y) of a (zoom, x, y) slippy map
+    tile in Web-Mercator degrees. Tile rows count down from the north.
+    """
+    zoom, x, y = tile
+    span = 360.0 / 2 ** zoom
+    return x * span - 180, 180 - (y + 1) * span, (x + 1) * span - 180, 180 - y * span
+
+
+def tile_bounds(tile):
+    """
+    Return (min lon, min lat, max lon, max lat) of a (zoom, x, y) tile.
+    """
+    extent = tile_extent(tile)
+    return extent[0], mercator_lat(extent[1]), extent[2], mercator_lat(extent[3])
+
+
+def tiles_in(extent, zoom, ring=0):
+    """
+    Return the (zoom, x, y) tiles overlapping a Web-Mercator extent,
+    grown by ring tiles each way.
+    """
+    count = 2 ** zoom
+    span = 360.0 / count
+    x0 = max(int(math.floor((extent[0] + 180) / span)) - ring, 0)
+    x1 = min(int(math.floor((extent[2] + 180) / span)) + ring, count - 1)
+    y0 = max(int(math.floor((180 - extent[3]) / span)) - ring, 0)
+    y1 = min(int(math.floor((180 - extent[1]) / span)) + ring, count - 1)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def tile_neighbours(tile):
+    """
+    Return a (zoom, x, y) tile and the tiles around it, up to nine.
+    """
+    zoom, x, y = tile
+    count = 2 ** zoom
+    return [(zoom, x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            if 0 <= x + dx < count and 0 <= y + dy < count]
+
+
+def tile_at(lon, lat, zoom):
+    y = mercator_y(lat)
+    return tiles_in((lon, y, lon, y), zoom)[0]
+
+
+class Maps(object):
+    """
+    Map data for one view, loaded a z/x/y tile at a time at zoom. The
+    view is origin +/- (width, height) in (lon, Web-Mercator y) degrees
+    and ways, tag positions and the spatial indexes are all projected
+    the same way; tags themselves keep their (lat, lon).
+    """
+    ways = None
+    tags = None
     origin = None
     width = 0
     height = 0
 
     SIG_PLACES = 3
-    GRID_SIZE = 0.001
+    zoom = config.MAP_TILE_ZOOM
+    API_URL = "http://www.openstreetmap.org/api/0.6/map?bbox=%f,%f,%f,%f"
+    FETCH_RETRIES = 5
+    # Delay before retrying a failed fetch, doubling each time up to the cap
+    FETCH_BACKOFF = 0.5
+    FETCH_BACKOFF_MAX = 8.0
+    # Besides 5xx, replies worth retrying after the backoff
+    FETCH_RETRY_STATUS = (429,)
+    FETCH_TIMEOUT = config.MAP_FETCH_TIMEOUT
+    # Way simplification levels in degrees, roughly 1m, 4m and 16m
+    LOD_TOLERANCES = (0.00001, 0.00004, 0.00016)
+
+    cache = MapCache(config.MAP_CACHE_DIR, config.MAP_CACHE_SIZE, config.MAP_CACHE_MAX_AGE)
+    atexit.register(cache.close)
+    store = MapStore(config.MAP_STORE_POINTS)
+    database = MapDatabase(config.MAP_DATABASE) if os.path.exists(config.MAP_DATABASE) else None
+    scheduler = FetchScheduler(config.MAP_FETCH_WORKERS)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=config.MAP_FETCH_WORKERS))
 
     def __init__(self, *args, **kwargs):
         super(Maps, self).__init__(*args, **kwargs)
+        self.tiles = []
+        self.ways = WayStore()
+        self.tags = []
+        self._tag_y = []
+        self.way_index = SpatialGrid([])
+        self.tag_index = SpatialGrid([])
 
     def float_floor_to_precision(self, value, precision):
         for i in range(precision):
@@ -30,121 +1488,278 @@ class Maps(object):
             value /= 10
         return value
 
-    def fetch_grid(self, coords):
-        # lat = self.float_floor_to_precision(coords[0], self.SIG_PLACES)
-        # lng = self.float_floor_to_precision(coords[1], self.SIG_PLACES)
-        # logging.info("Lat:{0} Lon:{1}".format(lat, lng))
-        lat = coords[0]
-        lng = coords[1]
-
-        return self.fetch_area([
-            lat - self.GRID_SIZE,
-            lng - self.GRID_SIZE,
-            lat + self.GRID_SIZE,
-            lng + self.GRID_SIZE
-        ])
-
-    def fetch_area(self, bounds):
-        self.width = (bounds[2] - bounds[0]) / 2
-        self.height = (bounds[3] - bounds[1]) / 2
+    def fit_tile(self, tile):
+        """
+        Fit the view to one (zoom, x, y) tile.
+        """
+        extent = tile_extent(tile)
+        self.width = self.height = (extent[2] - extent[0]) / 2
+        self.origin = (extent[0] + self.width, extent[1] + self.height)
+
+    def fit_area(self, bounds):
+        """
+        Centre a square view as wide as (min lon, min lat, max lon, max
+        lat) bounds on them.
+        """
+        self.width = self.height = (bounds[2] - bounds[0]) / 2
         self.origin = (
             bounds[0] + self.width,
-            bounds[1] + self.height
-        )
-        url = "http://www.openstreetmap.org/api/0.6/map?bbox=%f,%f,%f,%f" % (
-            bounds[0],
-            bounds[1],
-            bounds[2],
-            bounds[3]
+            float(mercator_y((bounds[1] + bounds[3]) / 2))
         )
-        logging.info("[Fetching maps... (%f, %f) to (%f, %f)]" % (
-            bounds[0],
-            bounds[1],
-            bounds[2],
-            bounds[3]
-        ))
-        while True:
+
+    def fetch_area(self, bounds, loaded=None, priority=0):
+        """
+        Fit the view to bounds and queue each tile it covers on the
+        scheduler, nearest the centre first, so they download side by
+        side and the middle of the view arrives first. loaded(tile) is
+        called on the worker thread as each one is stored; loading it is
+        left to the thread that draws the map, so fetching never swaps
+        the data out from under a frame being drawn. Returns a dict of
+        tile -> FetchJob.
+        """
+        self.fit_area(bounds)
+        span = 360.0 / 2 ** self.zoom
+
+        def distance(tile):
+            extent = tile_extent(tile)
+            return math.hypot((extent[0] + extent[2]) / 2 - self.origin[0],
+                              (extent[1] + extent[3]) / 2 - self.origin[1]) / span
+
+        jobs = {}
+        # submitted in order too, as idle workers start on the first that's queued
+        for tile in sorted(tiles_in(self.extent(), self.zoom), key=distance):
+            jobs[tile] = self.scheduler.submit(
+                self._fetch_tile, (tile, loaded), priority + distance(tile), tile_key(tile))
+        return jobs
+
+    def _fetch_tile(self, tile, loaded):
+        if self.store_tile(tile) is not None and loaded is not None:
+            loaded(tile)
+
+    def extent(self):
+        return (self.origin[0] - self.width, self.origin[1] - self.height,
+                self.origin[0] + self.width, self.origin[1] + self.height)
+
+    def store_tile(self, tile):
+        return self.store_area(tile_bounds(tile), tile_key(tile))
+
+    def store_area(self, bounds, key=None):
+        """
+        Make sure the map data for bounds is in the store, reading it from
+        the offline database, the disk cache or the OSM API in that order.
+        Returns the store key, or None if the data couldn't be had.
+        """
+        if key is None:
+            key = MapCache.key(bounds)
+        if key in self.store:
+            return key
+        # the modification time of the file the data came from versions it
+        if self.database is not None and self.database.covers(bounds):
+            rows, tags = self.database.query(bounds)
+            ways = WayStore()
+            ways.extend([points for way_id, points, style in rows], [style for way_id, points, style in rows],
+                        [int(way_id) for way_id, points, style in rows])
+            version = os.path.getmtime(self.database.path)
+        else:
+            map_file = None
+            path = self.cache.get(key)
+            if path is not None:
+                logging.info("[Map cache hit (%f, %f) to (%f, %f)]" % tuple(bounds))
+                map_file = self._read_map(path)
+            # refetch anything unreadable, such as tiles cached in an older format
+            if map_file is None:
+                path = self.download_area(bounds, key)
+                if path is None:
+                    # max age only asks for a refresh, old data beats none
+                    path = self.cache.get(key, allow_stale=True)
+                    if path is not None:
+                        logging.info("[Map cache stale (%f, %f) to (%f, %f)]" % tuple(bounds))
+                if path is None:
+                    return None
+                map_file = self._read_map(path)
+                if map_file is None:
+                    return None
             try:
-                response = requests.get(url)
-            except:
-                pass
+                ways, tags = map_file.ways(), map_file.tags()
+                version = os.path.getmtime(map_file.path)
+            finally:
+                map_file.close()
+        self.store.add_tile(key, self._tile_ways(ways), tags, version)
+        return key
+
+    def _tile_ways(self, ways):
+        """
+        Convert a tile's WayStore of (lat, lon) ways to view coordinates
+        in place and build its simplified levels, on the fetching thread,
+        so loading a view only has to join tiles together.
+        """
+        ways.coords[:, 0] = mercator_y(ways.coords[:, 0])
+        ways.build_levels(self.LOD_TOLERANCES)
+        return ways
+
+    def _read_map(self, path):
+        try:
+            return MapFile(path)
+        except MapFormatError, e:
+            logging.error("Unreadable map data {0}: {1}".format(path, e))
+            return None
+
+    def load_tiles(self, keys):
+        """
+        Replace this instance's ways and tags with those of stored tiles.
+        """
+        ways, tags = self.store.tiles(keys)
+        # stored by style so draw_lists batches are contiguous runs
+        ways = ways.subset(numpy.argsort(ways.styles, kind='mergesort'))
+        tag_y = mercator_y([tag[0] for tag in tags]).tolist()
+        way_index = SpatialGrid(ways.bounds())
+        tag_index = SpatialGrid([(tag[1], y, tag[1], y) for tag, y in zip(tags, tag_y)])
+        self.ways, self.tags, self._tag_y = ways, tags, tag_y
+        self.way_index, self.tag_index = way_index, tag_index
+        self.tiles = list(keys)
+
+    def find_poi(self, prefix='', amenity=None, near=None, limit=10):
+        """
+        Find up to limit named amenities in any stored tile by name prefix
+        and optionally amenity, nearest to a (lat, lon) near point first
+        if one is given, e.g. find_poi(amenity='pharmacy', near=(lat, lon)).
+        """
+        return self.store.find_poi(prefix, amenity, near, limit)
+
+    def nearest_poi(self, near, k, amenity=None, max_distance=None):
+        """
+        Return up to k (metres, tag) pairs for the stored amenities nearest
+        to a (lat, lon) near point by great circle distance, nearest first.
+        """
+        return self.store.nearest_poi(near, k, amenity, max_distance)
+
+    def pois_within(self, near, radius, amenity=None):
+        """
+        Return (metres, tag) pairs for every stored amenity within radius
+        metres of a (lat, lon) near point, nearest first.
+        """
+        return self.store.pois_within(near, radius, amenity)
+
+    def download_area(self, bounds, key):
+        url = self.API_URL % tuple(bounds)
+        logging.info("[Fetching maps... (%f, %f) to (%f, %f)]" % tuple(bounds))
+        for attempt in range(self.FETCH_RETRIES):
+            try:
+                response = self.session.get(url, stream=True, timeout=self.FETCH_TIMEOUT)
+            except requests.RequestException, e:
+                logging.warning("Map fetch failed ({0}): {1}".format(e, url))
             else:
-                break
-        osm_dict = xmltodict.parse(response.text.encode('UTF-8'))
+                if response.status_code == 200:
+                    break
+                response.close()
+                if response.status_code not in self.FETCH_RETRY_STATUS and response.status_code < 500:
+                    logging.error("Map fetch failed ({0}): {1}".format(response.status_code, url))
+                    return None
+                logging.warning("Map fetch failed ({0}): {1}".format(response.status_code, url))
+            time.sleep(min(self.FETCH_BACKOFF * 2 ** attempt, self.FETCH_BACKOFF_MAX))
+        else:
+            return None
+        # parsed once as it streams in, then cached in binary so it never needs parsing again
+        response.raw.decode_content = True
         try:
-            for node in osm_dict['osm']['node']:
-                self.nodes[node['@id']] = node
-                if 'tag' in node:
-                    for tag in node['tag']:
-                        try:
-                            # Named Amenities
-                            if tag["@k"] == "name":
-                                for tag2 in node['tag']:
-                                    if tag2["@k"] == "amenity":
-                                        amenity = tag2["@v"]
-                                self.tags.append((float(node['@lat']), float(node['@lon']), tag["@v"], amenity))
-                            # Personal Addresses - Removed
-                            # if tag["@k"] == "addr:housenumber":
-                            #	   for t2 in node['tag']:
-                            #			   if t2["@k"] == "addr:street":
-                            #					   self.tags.append((float(node['@lat']), float(node['@lon']),tag["@v"]+" "+t2["@v"]))
-                        except Exception, e:
-                            pass
-
-            for way in osm_dict['osm']['way']:
-                waypoints = []
-                for node_id in way['nd']:
-                    node = self.nodes[node_id['@ref']]
-                    waypoints.append((float(node['@lat']), float(node['@lon'])))
-                self.ways.append(waypoints)
-        except Exception, e:
-            logging.error(e)
-        # logging.error('{0}'.format(e))
-
-    def fetch_by_coordinate(self, coords, range):
+            nodes, ways, tags = parse_osm(response.raw)
+        except (ElementTree.ParseError, IOError, requests.packages.urllib3.exceptions.HTTPError), e:
+            logging.error("Unreadable map data {0}: {1}".format(url, e))
+            return None
+        finally:
+            response.close()
+        return self.cache.put(key, map_chunks(nodes.resolve_ways(ways), tags))
+
+    def fetch_by_coordinate(self, coords, range, loaded=None):
         return self.fetch_area((
             coords[0] - range,
             coords[1] - range,
             coords[0] + range,
             coords[1] + range
-        ))
-
-    def transpose_ways(self, dimensions, offset, flip_y=True):
-        width = dimensions[0]
-        height = dimensions[1]
-        w_coef = width / self.width / 2
-        h_coef = height / self.height / 2
-        transways = []
-        for way in self.ways:
-            transway = []
-            for waypoint in way:
-                lat = waypoint[1] - self.origin[0]
-                lng = waypoint[0] - self.origin[1]
-                wp = [
-                    (lat * w_coef) + offset[0],
-                    (lng * h_coef) + offset[1]
-                ]
-                if flip_y:
-                    wp[1] *= -1
-                    wp[1] += offset[1] * 2
-                transway.append(wp)
-            transways.append(transway)
-        return transways
-
-    def transpose_tags(self, dimensions, offset, flip_y=True):
-        width = dimensions[0]
-        height = dimensions[1]
-        w_coef = width / self.width / 2
-        h_coef = height / self.height / 2
+        ), loaded)
+
+    def scale(self, dimensions):
+        """
+        Pixels per degree of (lon, lat) when the fetched area spans dimensions.
+        """
+        return (
+            dimensions[0] / self.width / 2,
+            dimensions[1] / self.height / 2
+        )
+
+    def viewport_bounds(self, dimensions, offset, viewport, flip_y=True):
+        """
+        Convert a screen space viewport rect (x, y, w, h) into a
+        (min lon, min y, max lon, max y) Web-Mercator extent.
+        """
+        w_coef, h_coef = self.scale(dimensions)
+        lons = [self.origin[0] + (x - offset[0]) / w_coef for x in (viewport[0], viewport[0] + viewport[2])]
+        lats = [self.origin[1] + (y - offset[1]) / h_coef for y in (viewport[1], viewport[1] + viewport[3])]
+        if flip_y:
+            lats = [2 * self.origin[1] - lat for lat in lats]
+        return min(lons), min(lats), max(lons), max(lats)
+
+    def query(self, bounds):
+        """
+        Return (way indices, tag indices) overlapping
+        a (min lon, min y, max lon, max y) Web-Mercator extent.
+        """
+        return self.way_index.query(bounds), self.tag_index.query(bounds)
+
+    def tile_rect(self, tile, dimensions, offset, flip_y=True):
+        """
+        Return the screen space pygame.Rect a (zoom, x, y) tile covers.
+        Its edges are snapped to a pixel grid fixed to the projection
+        rather than the view, so neighbouring tiles meet exactly and a
+        tile is the same size wherever it is drawn.
+        """
+        w_coef, h_coef = self.scale(dimensions)
+        extent = tile_extent(tile)
+        if flip_y:
+            h_coef = -h_coef
+            extent = (extent[0], extent[3], extent[2], extent[1])
+        x0, x1 = int(math.floor(extent[0] * w_coef)), int(math.floor(extent[2] * w_coef))
+        y0, y1 = int(math.floor(extent[1] * h_coef)), int(math.floor(extent[3] * h_coef))
+        return pygame.Rect(int(math.floor(offset[0] - self.origin[0] * w_coef)) + x0,
+                           int(math.floor(offset[1] - self.origin[1] * h_coef)) + y0,
+                           x1 - x0, y1 - y0)
+
+    def transpose_ways(self, dimensions, offset, flip_y=True, viewport=None):
+        indices = None
+        if viewport is not None:
+            indices = self.way_index.query(self.viewport_bounds(dimensions, offset, viewport, flip_y))
+        return self.ways.transpose(self.origin, self.scale(dimensions), offset, flip_y, indices)
+
+    def draw_lists(self, dimensions, offset, flip_y=True, viewport=None):
+        """
+        Return the ways like transpose_ways but as (style name, [ways])
+        batches, see WayStore.draw_lists.
+        """
+        indices = None
+        if viewport is not None:
+            indices = self.way_index.query(self.viewport_bounds(dimensions, offset, viewport, flip_y))
+        return self.ways.draw_lists(self.origin, self.scale(dimensions), offset, flip_y, indices)
+
+    def transpose_tags(self, dimensions, offset, flip_y=True, viewport=None):
+        """
+        Return [name, x, y, amenity, index into self.tags] for each tag.
+        """
+        w_coef, h_coef = self.scale(dimensions)
+        if viewport is not None:
+            indices = self.tag_index.query(self.viewport_bounds(dimensions, offset, viewport, flip_y))
+        else:
+            indices = range(len(self.tags))
         transtags = []
-        for tag in self.tags:
+        for i in indices:
+            tag = self.tags[i]
             lat = tag[1] - self.origin[0]
-            lng = tag[0] - self.origin[1]
+            lng = self._tag_y[i] - self.origin[1]
             wp = [
                 tag[2],
                 (lat * w_coef) + offset[0],
                 (lng * h_coef) + offset[1],
-                tag[3]
+                tag[3],
+                i
             ]
             if flip_y:
                 wp[2] *= -1
@@ -153,6 +1768,189 @@ class Maps(object):
         return transtags
 
 
+class Prefetcher(object):
+    """
+    Watches a map being panned and fetches the tiles ahead of it in the
+    background, so continuous panning doesn't run into unloaded areas.
+    Tiles are the mapper's z/x/y tiles at its zoom and views are given
+    as Web-Mercator extents. Beyond the current view nothing more is
+    queued once the store holds budget points.
+    """
+    # Queued behind anything the user is already waiting on
+    PRIORITY = 100
+    # Seconds of panning at the current velocity to stay ahead of
+    LOOKAHEAD = 1.0
+    SMOOTHING = 0.5
+
+    def __init__(self, mapper, budget, loaded=None):
+        self.mapper = mapper
+        self.budget = budget
+        self.loaded = loaded
+        self.velocity = (0.0, 0.0)
+        self._centre = None
+        self._time = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def keys(self, bounds):
+        """
+        Return store keys of the tiles already fetched in and around bounds.
+        """
+        keys = [tile_key(tile) for tile in tiles_in(bounds, self.mapper.zoom, 1)]
+        return [key for key in keys if key in self.mapper.store]
+
+    def moved(self, bounds):
+        """
+        Update the pan velocity from the view's new Web-Mercator extent
+        and queue the tiles it is heading into.
+        """
+        now = time.time()
+        centre = ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)
+        if self._centre is not None and now > self._time:
+            elapsed = now - self._time
+            self.velocity = tuple(
+                self.SMOOTHING * ((centre[i] - self._centre[i]) / elapsed) + (1 - self.SMOOTHING) * self.velocity[i]
+                for i in range(2))
+        self._centre, self._time = centre, now
+
+        shift = (self.velocity[0] * self.LOOKAHEAD, self.velocity[1] * self.LOOKAHEAD)
+        ahead = (bounds[0] + shift[0], bounds[1] + shift[1], bounds[2] + shift[0], bounds[3] + shift[1])
+        # the next ring of tiles in the direction of travel
+        span = 360.0 / 2 ** self.mapper.zoom
+        step = [math.copysign(span, v) if v else 0 for v in self.velocity]
+        ahead = (min(ahead[0], ahead[0] + step[0]), min(ahead[1], ahead[1] + step[1]),
+                 max(ahead[2], ahead[2] + step[0]), max(ahead[3], ahead[3] + step[1]))
+        visible = set(tiles_in(bounds, self.mapper.zoom))
+        wanted = visible.union(tiles_in(ahead, self.mapper.zoom))
+
+        with self._lock:
+            for tile, job in list(self._jobs.items()):
+                if tile not in wanted:
+                    job.cancel()
+                    del self._jobs[tile]
+            target = ((ahead[0] + ahead[2]) / 2, (ahead[1] + ahead[3]) / 2)
+            for tile in wanted:
+                if tile in self._jobs or tile_key(tile) in self.mapper.store:
+                    continue
+                if tile not in visible and self.mapper.store.points >= self.budget:
+                    continue
+                extent = tile_extent(tile)
+                distance = math.hypot((extent[0] + extent[2]) / 2 - target[0],
+                                      (extent[1] + extent[3]) / 2 - target[1])
+                self._jobs[tile] = self.mapper.scheduler.submit(
+                    self._fetch, (tile,), self.PRIORITY + distance / span, tile_key(tile))
+
+    def _fetch(self, tile):
+        key = self.mapper.store_tile(tile)
+        with self._lock:
+            self._jobs.pop(tile, None)
+        if key is not None and self.loaded is not None:
+            self.loaded(tile)
+
+
+class PcmStream(object):
+    """
+    Samples of a WAV file decoded CHUNK frames at a time into a ring
+    buffer of the most recent seconds of audio, so analysing the track
+    around the play position takes memory for that window rather than
+    for the whole track. Reading behind the buffer or far ahead of it
+    seeks and decodes afresh; reading just ahead decodes forward.
+    """
+    CHUNK = 4096
+    # Scale every sample width to the range of 16 bit samples
+    FORMATS = {1: (numpy.uint8, 256.0, -128 * 256.0), 2: (numpy.int16, 1.0, 0.0), 4: (numpy.int32, 2 ** -16, 0.0)}
+
+    def __init__(self, filename, seconds=4.0):
+        self.filename = filename
+        self._reader = wave.open(filename, 'rb')
+        if self._reader.getsampwidth() not in self.FORMATS:
+            raise ValueError("Unsupported sample width {0} in {1}".format(self._reader.getsampwidth(), filename))
+        self.rate = self._reader.getframerate()
+        self.channels = self._reader.getnchannels()
+        self.length = self._reader.getnframes()
+        self.capacity = int(seconds * self.rate) + self.CHUNK
+        self._buffer = numpy.zeros((self.capacity, self.channels), dtype=numpy.float32)
+        # absolute frames start to end are in the buffer, frame i at i % capacity
+        self._start = self._end = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._reader.close()
+
+    def channel(self, select=None):
+        """
+        Return a PcmChannel of all channels, one channel by index, or
+        their mean with 'mono'.
+        """
+        return PcmChannel(self, select)
+
+    def read(self, first, count):
+        """
+        Return frames first to first + count as a (count, channels)
+        array, repeating the first or last frame outside of the track.
+        """
+        if count > self.capacity - self.CHUNK:
+            raise ValueError("Can't read {0} frames from a {1} frame buffer".format(count, self.capacity - self.CHUNK))
+        last = max(self.length - 1, 0)
+        with self._lock:
+            # the frames actually indexed, the first or last one at least
+            low = min(max(first, 0), last)
+            high = min(max(first + count, low + 1), self.length)
+            self._fill(low, high)
+            index = numpy.clip(numpy.arange(first, first + count), 0, last)
+            return self._buffer[index % self.capacity]
+
+    def _fill(self, low, high):
+        if self._start <= low and high <= self._end:
+            return
+        if not self._start <= low <= self._end or high - self._end > self.capacity:
+            self._reader.setpos(low)
+            self._start = self._end = low
+        dtype, scale, offset = self.FORMATS[self._reader.getsampwidth()]
+        while self._end < high:
+            frames = numpy.frombuffer(self._reader.readframes(min(self.CHUNK, high - self._end)), dtype=dtype)
+            frames = frames.reshape(-1, self.channels) * scale + offset
+            if not len(frames):
+                break
+            self._buffer[numpy.arange(self._end, self._end + len(frames)) % self.capacity] = frames
+            self._end += len(frames)
+        self._start = max(self._start, self._end - self.capacity)
+
+
+class PcmChannel(object):
+    """
+    One channel, all channels or the mono mix of a PcmStream, sliced like
+    the sample arrays SoundSpectrum.get takes.
+    """
+
+    def __init__(self, stream, select=None):
+        self.stream = stream
+        self.select = select
+        if select is None:
+            self.shape = (stream.channels, stream.length)
+        else:
+            self.shape = (stream.length,)
+
+    def __len__(self):
+        return self.shape[-1]
+
+    def frames(self, first, count):
+        """
+        Return count samples from each of one or an array of first
+        frames, with time along the last axis.
+        """
+        if numpy.ndim(first) == 0:
+            frames = self.stream.read(int(first), count)
+        else:
+            frames = numpy.array([self.stream.read(int(f), count) for f in numpy.ravel(first)])
+            frames = frames.reshape(numpy.shape(first) + (count, self.stream.channels))
+        if self.select is None:
+            return numpy.rollaxis(frames, -1)
+        if self.select == 'mono':
+            return frames.mean(axis=-1)
+        return frames[..., self.select]
+
+
 class SoundSpectrum:
     """
 	Obtain the spectrum in a time interval from a sound file. 
@@ -160,51 +1958,101 @@ class SoundSpectrum:
 
     left = None
     right = None
+    samples = None
 
-    def __init__(self, filename, force_mono=False):
+    def __init__(self, filename, force_mono=False, stream=False):
         """
 		Create a new SoundSpectrum instance given the filename of 
 		a sound file pygame can read. If the sound is stereo, two 
 		spectra are available. Optionally mono can be forced. 
+		With stream, a WAV file is decoded a chunk at a time 
+		around the times asked for instead of all at once. 
 		"""
         # Get playback frequency
         nu_play, format, stereo = pygame.mixer.get_init()
         self.nu_play = 1. / nu_play
         self.format = format
         self.stereo = stereo
+        # (Hann window, FFT size, power scale, frequencies) by frame length
+        self._plans = {}
+
+        if stream:
+            try:
+                source = PcmStream(filename)
+            except (wave.Error, EOFError, ValueError), e:
+                # pygame can only decode compressed formats whole
+                logging.info("Not streaming {0}: {1}".format(filename, e))
+            else:
+                self.nu_play = 1. / source.rate
+                self.stereo = int(source.channels > 1 and not force_mono)
+                if self.stereo:
+                    self.samples = source.channel()
+                    self.left = source.channel(0)
+                    self.right = source.channel(1)
+                else:
+                    self.left = source.channel('mono')
+                return
 
         # Load sound and convert to array(s)
         sound = pygame.mixer.Sound(filename)
         a = pygame.sndarray.array(sound)
-        a = numpy.array(a)
         if stereo:
             if force_mono:
                 self.stereo = 0
                 self.left = (a[:, 0] + a[:, 1]) * 0.5
             else:
+                # the channels are views of the one array
+                self.samples = a
                 self.left = a[:, 0]
                 self.right = a[:, 1]
         else:
             self.left = a
 
+    def plan(self, length):
+        """
+		Return the (window, FFT size, power scale, frequencies) 
+		used for frames of length samples, computed once per 
+		length. Frames are zero padded to a power of two, which 
+		FFTs much faster than an arbitrary length. 
+		"""
+        if length not in self._plans:
+            window = numpy.hanning(length)
+            size = 1 << max(length - 1, 1).bit_length()
+            frequency = numpy.arange(1, 1 + size // 2) / (size * self.nu_play)
+            self._plans[length] = (window, size, 1.0 / window.sum() ** 2, frequency)
+        return self._plans[length]
+
     def get(self, data, start, stop):
         """
 		Return spectrum of given data, between start and stop 
-		time in seconds. 
+		time in seconds, as (frequencies, power). data's last 
+		axis is time, so a (channels, samples) array gives a 
+		spectrum per channel. start and stop may also be arrays 
+		of equally long intervals, giving a batch of spectra in 
+		one call. The frame is Hann windowed and the power is 
+		the squared magnitude of its real FFT, normalised by the 
+		window's gain. 
 		"""
-        duration = stop - start
-        # Filter data
-        start = int(start / self.nu_play)
-        stop = int(stop / self.nu_play)
-        N = stop - start
-        data = data[start:stop]
-
-        # Get frequencies
-        frequency = numpy.arange(N / 2) / duration
+        if numpy.ndim(start) == 0:
+            first = int(start / self.nu_play)
+            N = int(stop / self.nu_play) - first
+        else:
+            first = (numpy.asarray(start, dtype=numpy.float64) / self.nu_play).astype(numpy.intp)
+            N = int(numpy.ravel(stop)[0] / self.nu_play) - int(numpy.ravel(first)[0])
+        if isinstance(data, PcmChannel):
+            frames = data.frames(first, N)
+        elif numpy.ndim(first) == 0 and 0 <= first and first + N <= data.shape[-1]:
+            frames = data[..., first:first + N]
+        else:
+            index = numpy.asarray(first)[..., numpy.newaxis] + numpy.arange(N)
+            frames = data[..., numpy.clip(index, 0, data.shape[-1] - 1)]
 
         # Calculate spectrum
-        spectrum = fft(data)[1:1 + N / 2]
-        power = (spectrum).real
+        window, size, scale, frequency = self.plan(N)
+        spectrum = rfft(frames * window, size)[..., 1:1 + size // 2]
+        power = spectrum.real ** 2
+        power += spectrum.imag ** 2
+        power *= scale
 
         return frequency, power
 
@@ -222,6 +2070,15 @@ class SoundSpectrum:
 		"""
         return self.get(self.right, start, stop)
 
+    def get_stereo(self, start, stop):
+        """
+		Return the spectra of both stereo channels between start 
+		and stop times in seconds, left first, in one call. 
+		Note: this only works if sound was loaded as stereo. 
+		"""
+        samples = self.samples if isinstance(self.samples, PcmChannel) else self.samples.T
+        return self.get(samples, start, stop)
+
     def get_mono(self, start, stop):
         """
 		Return mono spectrum between start and stop times in seconds. 
@@ -234,11 +2091,11 @@ class SoundSpectrum:
 class LogSpectrum(SoundSpectrum):
     """
 	A SoundSpectrum where the spectrum is divided into 
-	logarithmic bins and the logarithm of the power is 
+	logarithmic bins and the power in each bin is 
 	returned. 
 	"""
 
-    def __init__(self, filename, force_mono=False, bins=20, start=1e2, stop=1e4):
+    def __init__(self, filename, force_mono=False, bins=20, start=1e2, stop=1e4, stream=False):
         """
 		Create a new LogSpectrum instance given the filename of 
 		a sound file pygame can read. If the sound is stereo, two 
@@ -246,24 +2103,224 @@ class LogSpectrum(SoundSpectrum):
 		The number of spectral bins as well as the frequency range 
 		can be specified. 
 		"""
-        SoundSpectrum.__init__(self, filename, force_mono=force_mono)
+        SoundSpectrum.__init__(self, filename, force_mono=force_mono, stream=stream)
         start = log10(start)
         stop = log10(stop)
         step = (stop - start) / bins
         self.bins = 10 ** numpy.arange(start, stop + step, step)
+        # (columns of the spectrum that land in a bin, their bin) by frame length
+        self._binning = {}
 
     def get(self, data, start, stop):
         """
 		Return spectrum of given data, between start and stop 
-		time in seconds. Spectrum is given as the log of the 
-		power in logatithmically equally sized bins. 
+		time in seconds. Spectrum is given as the power summed 
+		into logarithmically equally sized bins, for every 
+		channel and frame SoundSpectrum.get returns. 
 		"""
         f, p = SoundSpectrum.get(self, data, start, stop)
-        bins = self.bins
-        length = len(bins)
-        result = numpy.zeros(length)
-        ind = numpy.searchsorted(bins, f)
-        for i, j in zip(ind, p):
-            if i < length:
-                result[i] += j
-        return bins, result
+        length = len(self.bins)
+        if len(f) not in self._binning:
+            ind = numpy.searchsorted(self.bins, f)
+            keep = numpy.flatnonzero(ind < length)
+            self._binning[len(f)] = (keep, ind[keep])
+        keep, ind = self._binning[len(f)]
+        if p.ndim == 1:
+            return self.bins, numpy.bincount(ind, weights=p[keep], minlength=length)
+        shape = p.shape[:-1]
+        p = p[..., keep].reshape(-1, len(keep))
+        # one bincount for every frame at once, each frame's bins offset into its own row
+        rows = numpy.arange(len(p))[:, numpy.newaxis] * length + ind
+        result = numpy.bincount(rows.ravel(), weights=p.ravel(), minlength=len(p) * length)
+        return self.bins, result.reshape(shape + (length,))
+
+
+class Spectrogram(object):
+    """
+    LogSpectrum frames of a whole track computed once, every HOP seconds,
+    and saved to a sidecar .npy file named after the track's path and
+    modification time. Playback memory maps the sidecar and looks frames
+    up by position, so no FFTs run while drawing and the decoded track
+    isn't kept in memory.
+    """
+    HOP = 0.02
+    # Matches the window the radio has always sampled around the play position
+    WINDOW = 0.002
+    # Frames analysed per batch while building
+    BATCH = 1024
+    VERSION = 2
+
+    def __init__(self, filename, directory=config.SPECTRUM_CACHE_DIR, bins=20, start=1e2, stop=1e4):
+        self.filename = filename
+        self.directory = directory
+        self.parameters = (bins, start, stop)
+        path = self.path()
+        if not os.path.exists(path):
+            self.build()
+        self.frames = numpy.load(path, mmap_mode='r')
+        step = (log10(stop) - log10(start)) / bins
+        self.bins = 10 ** numpy.arange(log10(start), log10(stop) + step, step)
+
+    def path(self):
+        return self.sidecar(self.filename, self.directory, self.parameters)
+
+    def close(self):
+        """
+        Unmap the sidecar; at() then returns silence.
+        """
+        self.frames = numpy.zeros((0, len(self.bins)), dtype=numpy.float32)
+
+    @classmethod
+    def sidecar(cls, filename, directory=config.SPECTRUM_CACHE_DIR, parameters=(20, 1e2, 1e4)):
+        """
+        Return where the sidecar for a track as it is now belongs, given
+        the (bins, start, stop) it is analysed with.
+        """
+        stat = os.stat(filename)
+        key = repr((os.path.abspath(filename), stat.st_mtime, stat.st_size,
+                    cls.HOP, cls.WINDOW, tuple(parameters), cls.VERSION))
+        return os.path.join(directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def build(self):
+        """
+        Decode the track, streaming it if it is a WAV file, and write its
+        sidecar.
+        """
+        path = self.path()
+        bins, start, stop = self.parameters
+        spectrum = LogSpectrum(self.filename, force_mono=True, bins=bins, start=start, stop=stop, stream=True)
+        duration = len(spectrum.left) * spectrum.nu_play
+        positions = numpy.arange(0, duration, self.HOP)
+        # windows are kept inside the track at its ends
+        begins = numpy.clip(positions - self.WINDOW / 2, 0, max(duration - self.WINDOW, 0))
+        frames = numpy.zeros((len(positions), len(spectrum.bins)), dtype=numpy.float32)
+        for i in range(0, len(begins), self.BATCH):
+            batch = begins[i:i + self.BATCH]
+            frames[i:i + self.BATCH] = spectrum.get_mono(batch, batch + self.WINDOW)[1]
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # pool workers are separate processes, whose threads can share an ident
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            numpy.save(f, frames)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        logging.info("[Spectrogram of %s: %d frames]" % (self.filename, len(frames)))
+
+    def at(self, position):
+        """
+        Return (bins, power) for the frame nearest position in seconds.
+        """
+        if not len(self.frames):
+            return self.bins, numpy.zeros(len(self.bins))
+        index = min(max(int(round(position / self.HOP)), 0), len(self.frames) - 1)
+        return self.bins, self.frames[index]
+
+    def get_mono(self, start, stop):
+        """
+        LogSpectrum.get_mono for the middle of start and stop.
+        """
+        return self.at((start + stop) / 2.0)
+
+
+def _init_spectrum_worker(mixer):
+    # the pool's parent never opens the mixer, so each worker has one of its
+    # own, for decoding, that doesn't open a sound device
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.mixer.init(*mixer)
+
+
+def _build_spectrogram(job):
+    filename, directory = job
+    try:
+        Spectrogram(filename, directory)
+    except Exception:
+        return filename, traceback.format_exc()
+    return filename, None
+
+
+class SpectrumPrecomputer(object):
+    """
+    Builds the Spectrogram sidecars of a library of tracks, one track per
+    process across all cores. Tracks whose sidecar is already up to date
+    for their current modification time are skipped, so an interrupted
+    run picks up where it left off and a rerun only analyses new or
+    changed tracks. progress, if given, is called with (done, total,
+    filename) as each track finishes.
+    """
+    SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'precompute_spectra.py')
+    # Background runs stay out of the way of the UI
+    NICENESS = 10
+
+    def __init__(self, filenames, directory=config.SPECTRUM_CACHE_DIR, processes=None, progress=None):
+        self.filenames = list(filenames)
+        self.directory = directory
+        self.processes = processes or multiprocessing.cpu_count()
+        self.progress = progress
+        self.done = 0
+        self.total = 0
+        self.failed = []
+        self.process = None
+
+    def pending(self):
+        return [filename for filename in self.filenames
+                if not os.path.exists(Spectrogram.sidecar(filename, self.directory))]
+
+    def start(self):
+        """
+        Run precompute_spectra.py on the pending tracks in a process of
+        its own, at a lower priority, and return without waiting for it
+        to finish; a thread waits for it instead.
+        The pool is forked from that process rather than this one, which
+        may have a display and a playing mixer open.
+        """
+        pending = self.pending()
+        if not pending:
+            return None
+        command = [sys.executable, self.SCRIPT, '--processes', str(self.processes),
+                   '--cache', self.directory] + pending
+        self.process = subprocess.Popen(command, cwd=os.path.dirname(self.SCRIPT),
+                                        preexec_fn=lambda: os.nice(self.NICENESS))
+        logging.info("[Analysing %d tracks in process %d]" % (len(pending), self.process.pid))
+        # reaped as soon as it exits rather than left a zombie until we do
+        waiter = threading.Thread(target=self._wait, args=(self.process,))
+        waiter.daemon = True
+        waiter.start()
+        return self.process
+
+    def _wait(self, process):
+        status = process.wait()
+        if status:
+            logging.error("Spectrum analysis process {0} exited with {1}".format(process.pid, status))
+        else:
+            logging.info("[Spectrum analysis process %d done]" % process.pid)
+
+    def run(self):
+        """
+        Analyse the pending tracks and return how many were analysed.
+        This forks the pool from the calling process, so call it from
+        one without a display or mixer open, as precompute_spectra.py
+        does; start() runs it that way.
+        """
+        pending = self.pending()
+        self.done = 0
+        self.total = len(pending)
+        if not pending:
+            return 0
+        mixer = pygame.mixer.get_init() or (44100, -16, 2)
+        logging.info("[Analysing %d of %d tracks on %d processes]" % (len(pending), len(self.filenames), self.processes))
+        # a fresh worker per track hands each decoded track's memory back
+        pool = multiprocessing.Pool(min(self.processes, len(pending)), _init_spectrum_worker, (mixer,), 1)
+        try:
+            for filename, error in pool.imap_unordered(_build_spectrogram, [(f, self.directory) for f in pending]):
+                self.done += 1
+                if error is not None:
+                    self.failed.append(filename)
+                    logging.error("Spectrum analysis of {0} failed: {1}".format(filename, error))
+                if self.progress is not None:
+                    self.progress(self.done, self.total, filename)
+        finally:
+            pool.close()
+            pool.join()
+        return self.done - len(self.failed)
@@ -1,8 +1,16 @@
+import hashlib
 import logging
+import math
 import os
 import threading
+from collections import OrderedDict
 from random import choice
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import pygame
 
 import game
@@ -10,6 +18,261 @@ import pypboy.data
 from pypboy import config
 
 
+class TileSurfaceCache(object):
+    """
+    Pre-rendered map tile surfaces keyed by (tile key, size, kind, style
+    version, data version), evicted least recently used first once they
+    hold more than max_pixels. With a directory, tiles are also saved
+    there as PNGs so they survive a restart, up to max_bytes of them
+    with the least recently used deleted first. PNGs are encoded and
+    written on a thread of their own, never while drawing a frame.
+    """
+    # Tiles waiting to be written; more than this and new ones aren't saved
+    WRITE_QUEUE = 32
+
+    def __init__(self, max_pixels, directory=None, max_bytes=0):
+        self.max_pixels = max_pixels
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pixels = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._surfaces = OrderedDict()
+        self._files = None
+        self._writes = queue.Queue(self.WRITE_QUEUE)
+        self._writer = None
+        self._lock = threading.RLock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, '_'.join(str(part) for part in key) + '.png')
+
+    def get(self, key, render, persist=True):
+        """
+        Return the surface for key, calling render() to draw it on a miss.
+        Tiles drawn from data that's still incomplete should pass persist
+        False, so they're only kept in memory until redrawn.
+        """
+        with self._lock:
+            if key in self._surfaces:
+                self.hits += 1
+                surface = self._surfaces.pop(key)
+                self._surfaces[key] = surface
+                return surface
+        self.misses += 1
+        surface = None
+        path = self._path(key) if self.directory else None
+        if path is not None and self._on_disk(path):
+            try:
+                surface = pygame.image.load(path).convert()
+            except pygame.error, e:
+                logging.error("Unreadable tile {0}: {1}".format(path, e))
+        if surface is None:
+            surface = render()
+            if path is not None and persist:
+                self._save(path, surface)
+        with self._lock:
+            if key not in self._surfaces:
+                self._surfaces[key] = surface
+                self.pixels += surface.get_width() * surface.get_height()
+            while self.pixels > self.max_pixels and len(self._surfaces) > 1:
+                evicted = self._surfaces.popitem(last=False)[1]
+                self.pixels -= evicted.get_width() * evicted.get_height()
+        return surface
+
+    def _on_disk(self, path):
+        with self._lock:
+            if self._files is None:
+                self._scan()
+            name = os.path.basename(path)
+            if name not in self._files:
+                return False
+            self._files[name] = self._files.pop(name)
+            return True
+
+    def _scan(self):
+        # oldest written first, the nearest to least recently used a restart knows of
+        files = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.tmp.png'):
+                    os.remove(path)
+                elif name.endswith('.png'):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name, stat.st_size))
+        self._files = OrderedDict((name, size) for mtime, name, size in sorted(files))
+        self.bytes = sum(self._files.values())
+
+    def _save(self, path, surface):
+        # copying the pixels is cheap, it's the PNG encoding that's left to the writer
+        write = (path, pygame.image.tostring(surface, 'RGB'), surface.get_size())
+        try:
+            self._writes.put_nowait(write)
+        except queue.Full:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write)
+                self._writer.daemon = True
+                self._writer.start()
+
+    def flush(self):
+        """
+        Wait for the tiles queued so far to be written.
+        """
+        self._writes.join()
+
+    def _write(self):
+        while True:
+            path, pixels, size = self._writes.get()
+            try:
+                self._write_file(path, pixels, size)
+            finally:
+                self._writes.task_done()
+
+    def _write_file(self, path, pixels, size):
+        temp_path = path[:-len('.png')] + '.tmp.png'
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            pygame.image.save(pygame.image.fromstring(pixels, size, 'RGB'), temp_path)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+            written = os.path.getsize(path)
+        except (pygame.error, OSError, IOError), e:
+            logging.error("Can't save tile {0}: {1}".format(path, e))
+            return
+        with self._lock:
+            if self._files is None:
+                self._scan()
+            name = os.path.basename(path)
+            self.bytes += written - self._files.pop(name, 0)
+            self._files[name] = written
+            while self.bytes > self.max_bytes and len(self._files) > 1:
+                name, evicted = self._files.popitem(last=False)
+                self.bytes -= evicted
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+tile_cache = TileSurfaceCache(config.MAP_TILE_CACHE_PIXELS, config.MAP_TILE_CACHE_DIR, config.MAP_TILE_CACHE_DISK_SIZE)
+
+
+def data_version(store, keys):
+    """
+    Return a short digest of the versions of the stored tiles among keys,
+    for telling a tile drawn from them apart from one drawn from other
+    data, and whether they were all stored. None stands for a tile that
+    wasn't drawn from.
+    """
+    stored = [key is not None and key in store for key in keys]
+    versions = [store.version(key) if found else None for key, found in zip(keys, stored)]
+    return hashlib.sha1(repr(versions).encode('utf-8')).hexdigest()[:12], all(stored)
+
+
+class IconAtlas(object):
+    """
+    config.MAP_ICONS pre-scaled to each size in sizes and converted to
+    the display format, packed side by side into one surface per size.
+    Icons are looked up by amenity; unknown amenities get 'misc'.
+    Built on first use, since converting needs the display to be set up.
+    """
+
+    def __init__(self, icons, amenities, sizes):
+        self.icons = icons
+        self.amenities = amenities
+        self.sizes = sizes
+        self._atlases = None
+        self._lookup = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        names = sorted(self.icons)
+        atlases = {}
+        lookup = {}
+        for size in self.sizes:
+            atlas = pygame.Surface((size * len(names), size), pygame.SRCALPHA).convert_alpha()
+            atlas.fill((0, 0, 0, 0))
+            icons = {}
+            for i, name in enumerate(names):
+                atlas.blit(pygame.transform.smoothscale(self.icons[name], (size, size)), (i * size, 0))
+                icons[name] = atlas.subsurface((i * size, 0, size, size))
+            by_amenity = {}
+            for amenity, image in self.amenities.items():
+                for name in names:
+                    if self.icons[name] is image:
+                        by_amenity[amenity] = icons[name]
+            atlases[size] = atlas
+            lookup[size] = (icons['misc'], by_amenity)
+        self._atlases = atlases
+        self._lookup = lookup
+
+    def get(self, amenity, size):
+        if self._lookup is None:
+            with self._lock:
+                if self._lookup is None:
+                    self._build()
+        misc, by_amenity = self._lookup[size]
+        if amenity not in by_amenity:
+            logging.info("Unknown amenity: %s" % amenity)
+            for other in self._lookup.values():
+                other[1][amenity] = other[0]
+        return by_amenity[amenity]
+
+
+icon_atlas = IconAtlas(config.MAP_ICONS, config.AMENITIES, config.MAP_ICON_SIZES)
+
+
+class LabelLayout(object):
+    """
+    Decides which map labels to draw so that none overlap. Labels are
+    placed in order of amenity priority (config.LABEL_PRIORITIES) and
+    each is tested only against the placed labels sharing its cells in
+    a screen space spatial hash. Rendered label text is cached.
+    """
+    CELL_SIZE = 32
+    # Where a label sits relative to its icon
+    OFFSET = (17, 4)
+
+    def __init__(self, font):
+        self.font = font
+        self.priorities = dict((amenity, i) for i, amenity in enumerate(config.LABEL_PRIORITIES))
+        self._text = {}
+
+    def place(self, tags):
+        """
+        Take (key, x, y, name, amenity) tuples and return the set of keys
+        whose labels can be drawn without colliding.
+        """
+        cells = {}
+        placed = set()
+        unranked = len(self.priorities)
+        for key, x, y, name, amenity in sorted(tags, key=lambda tag: (self.priorities.get(tag[4], unranked), tag[3])):
+            width, height = self.font.size(name)
+            rect = pygame.Rect(x + self.OFFSET[0], y + self.OFFSET[1], width, height)
+            covered = [(cx, cy)
+                       for cx in range(rect.left // self.CELL_SIZE, rect.right // self.CELL_SIZE + 1)
+                       for cy in range(rect.top // self.CELL_SIZE, rect.bottom // self.CELL_SIZE + 1)]
+            if any(rect.collidelist(cells.get(cell, [])) != -1 for cell in covered):
+                continue
+            for cell in covered:
+                cells.setdefault(cell, []).append(rect)
+            placed.add(key)
+        return placed
+
+    def render(self, name):
+        if name not in self._text:
+            self._text[name] = self.font.render(name, True, (95, 255, 177), (0, 0, 0))
+        return self._text[name]
+
+    def clear(self):
+        self._text = {}
+
+
 class Map(game.Entity):
     _mapper = None
     _transposed = None
@@ -18,55 +281,181 @@ class Map(game.Entity):
     _map_surface = None
     _loading_size = 0
     _render_rect = None
+    # Room left of and above the viewport for icons and labels that spill into it
+    LABEL_MARGIN = (150, 20)
+    # Bump whenever the way colours or widths change, to skip stale cached tiles
+    STYLE_VERSION = 2
+    # Pixels per degree from which icons are drawn at full size
+    ICON_ZOOM = 50000
 
     def __init__(self, width, render_rect=None, *args, **kwargs):
         self._mapper = pypboy.data.Maps()
+        self._prefetcher = pypboy.data.Prefetcher(self._mapper, config.MAP_PREFETCH_POINTS, self._tile_loaded)
         self._size = width
-        self._map_surface = pygame.Surface((width, width))
+        self._map_surface = pygame.Surface(render_rect.size)
         self._render_rect = render_rect
+        self._labels = LabelLayout(config.FONTS[12])
+        self._placement = set()
+        self._placement_key = None
+        # Tiles stored by the fetch threads since the last frame
+        self._arrived = set()
+        self._arrived_lock = threading.Lock()
         super(Map, self).__init__((width, width), *args, **kwargs)
         text = config.FONTS[14].render("Loading map...", True, (95, 255, 177), (0, 0, 0))
         self.image.blit(text, (10, 10))
 
     def fetch_map(self, position, radius):
         # (-5.9234923, 54.5899493)
-        self._fetching = threading.Thread(target=self._internal_fetch_map, args=(position, radius))
-        self._fetching.start()
-
-    def _internal_fetch_map(self, position, radius):
-        self._mapper.fetch_by_coordinate(position, radius)
-        self.redraw_map()
+        # a job per tile, each drawn as it arrives
+        self._fetching = self._mapper.fetch_by_coordinate(position, radius, self._tile_loaded)
 
     def update(self, *args, **kwargs):
         super(Map, self).update(*args, **kwargs)
 
+    def render(self, *args, **kwargs):
+        with self._arrived_lock:
+            arrived, self._arrived = self._arrived, set()
+        # however many tiles arrived, they're loaded and drawn once
+        if arrived and self._load_view():
+            self.redraw_map()
+        super(Map, self).render(*args, **kwargs)
+
     def move_map(self, x, y):
         self._render_rect.move_ip(x, y)
-
-    def redraw_map(self, coef=1):
-        self._map_surface.fill((0, 0, 0))
-        for way in self._mapper.transpose_ways((self._size / coef, self._size / coef),
-                                               (self._size / 2, self._size / 2)):
-            pygame.draw.lines(
-                self._map_surface,
-                (85, 251, 167),
-                False,
-                way,
-                2
-            )
-        for tag in self._mapper.transpose_tags((self._size / coef, self._size / coef),
-                                               (self._size / 2, self._size / 2)):
-            if tag[3] in config.AMENITIES:
-                image = config.AMENITIES[tag[3]]
+        if self._mapper.origin is not None:
+            bounds = self._view_bounds()
+            self._prefetcher.moved(bounds)
+            if self._fetching:
+                # the prefetcher takes over from here, so drop what has scrolled out of reach
+                wanted = set(pypboy.data.tiles_in(bounds, self._mapper.zoom, 1))
+                for tile, job in list(self._fetching.items()):
+                    if tile not in wanted:
+                        job.cancel()
+                        del self._fetching[tile]
+            if self._load_view():
+                self.redraw_map()
             else:
-                logging.info("Unknown amenity: %s" % tag[3])
-                image = config.MAP_ICONS['misc']
-            pygame.transform.scale(image, (10, 10))
-            self._map_surface.blit(image, (tag[1], tag[2]))
-            text = config.FONTS[12].render(tag[0], True, (95, 255, 177), (0, 0, 0))
-            self._map_surface.blit(text, (tag[1] + 17, tag[2] + 4))
+                self._scroll_map(x, y)
+
+    def _load_view(self):
+        """
+        Load the stored tiles in and around the view if they aren't the
+        ones loaded already, returning whether they changed. Only called
+        on the main thread, the one that draws.
+        """
+        keys = self._prefetcher.keys(self._view_bounds())
+        if keys == self._mapper.tiles:
+            return False
+        self._mapper.load_tiles(keys)
+        return True
+
+    def _scroll_map(self, x, y):
+        """
+        Shift what is already drawn by the pan delta and only draw the
+        strips that it uncovers.
+        """
+        view = self._map_surface.get_rect()
+        if abs(x) >= view.width or abs(y) >= view.height:
+            self.redraw_map()
+            return
+        self._map_surface.scroll(-x, -y)
+        if x:
+            self._draw_area(pygame.Rect(view.width - x if x > 0 else 0, 0, abs(x), view.height))
+        if y:
+            self._draw_area(pygame.Rect(0, view.height - y if y > 0 else 0, view.width, abs(y)))
+        self.image.blit(self._map_surface, (0, 0))
+
+    def _tile_loaded(self, tile):
+        # Called on a fetch thread, so just noted for render() to load
+        with self._arrived_lock:
+            self._arrived.add(tile)
+
+    def _projection(self, coef=1):
+        """
+        Return the (dimensions, offset) that put the current render rect
+        at the top left of _map_surface.
+        """
+        return ((self._size / coef, self._size / coef),
+                (self._size / 2 - self._render_rect[0], self._size / 2 - self._render_rect[1]))
+
+    def _view_bounds(self):
+        dimensions, offset = self._projection()
+        return self._mapper.viewport_bounds(dimensions, offset, self._map_surface.get_rect())
 
-        self.image.blit(self._map_surface, (0, 0), area=self._render_rect)
+    def redraw_map(self, coef=1):
+        self._draw_area(self._map_surface.get_rect(), coef)
+        self.image.blit(self._map_surface, (0, 0))
+
+    def _draw_area(self, area, coef=1):
+        """
+        Redraw just the given rect of _map_surface, clipped to it.
+        """
+        self._map_surface.set_clip(area)
+        self._map_surface.fill((0, 0, 0), area)
+        dimensions, offset = self._projection(coef)
+        viewport = area.inflate(self.LABEL_MARGIN[0], self.LABEL_MARGIN[1])
+        viewport.move_ip(-self.LABEL_MARGIN[0] / 2, -self.LABEL_MARGIN[1] / 2)
+        extent = self._mapper.viewport_bounds(dimensions, offset, area)
+        for tile in pypboy.data.tiles_in(extent, self._mapper.zoom):
+            key = pypboy.data.tile_key(tile)
+            if key not in self._mapper.tiles:
+                continue
+            # ways cross in from the tiles around, so it is only final once they're loaded too
+            neighbours = [pypboy.data.tile_key(other) for other in pypboy.data.tile_neighbours(tile)]
+            version, complete = data_version(
+                self._mapper.store, [other if other in self._mapper.tiles else None for other in neighbours])
+            # keyed by scale rather than view, so any map drawing this tile at this scale can reuse it
+            surface = tile_cache.get((key, self._mapper.scale(dimensions)[0], 'map', self.STYLE_VERSION, version),
+                                     lambda: self._render_tile(tile, dimensions), complete)
+            self._map_surface.blit(surface, self._mapper.tile_rect(tile, dimensions, offset))
+        icon_size = self.icon_size(dimensions)
+        labels = self._placed_labels(dimensions)
+        for tag in self._mapper.transpose_tags(dimensions, offset, viewport=viewport):
+            # floor rather than let blit truncate, so strips drawn after a scroll line up
+            x, y = int(math.floor(tag[1])), int(math.floor(tag[2]))
+            self._map_surface.blit(icon_atlas.get(tag[3], icon_size), (x, y))
+            if tag[4] in labels:
+                self._map_surface.blit(self._labels.render(tag[0]),
+                                       (x + LabelLayout.OFFSET[0], y + LabelLayout.OFFSET[1]))
+        self._map_surface.set_clip(None)
+
+    def _placed_labels(self, dimensions):
+        """
+        Return the indices of the tags whose labels get drawn. Placement is
+        done for every loaded tag in a frame that doesn't move with the
+        view, so it only changes with the zoom or the loaded tiles.
+        """
+        mapper = self._mapper
+        # load_tiles replaces mapper.tags, so identity is enough to spot new tiles
+        if self._placement_key is None or self._placement_key[0] != dimensions or \
+                self._placement_key[1] is not mapper.tags:
+            self._labels.clear()
+            self._placement = self._labels.place(
+                (tag[4], int(tag[1]), int(tag[2]), tag[0], tag[3]) for tag in mapper.transpose_tags(dimensions, (0, 0)))
+            self._placement_key = (dimensions, mapper.tags)
+        return self._placement
+
+    def icon_size(self, dimensions):
+        """
+        Full size icons when zoomed in, small ones when zoomed out.
+        """
+        if self._mapper.scale(dimensions)[0] >= self.ICON_ZOOM:
+            return config.MAP_ICON_SIZES[-1]
+        return config.MAP_ICON_SIZES[0]
+
+    def _render_tile(self, tile, dimensions):
+        """
+        Draw the ways crossing one tile onto a surface of its own.
+        """
+        rect = self._mapper.tile_rect(tile, dimensions, (0, 0))
+        surface = pygame.Surface(rect.size).convert()
+        surface.fill((0, 0, 0))
+        draw_lines = pygame.draw.lines
+        for style, ways in self._mapper.draw_lists(dimensions, (-rect.x, -rect.y), viewport=surface.get_rect()):
+            colour, width = config.MAP_WAY_STYLES[style]
+            for way in ways:
+                draw_lines(surface, colour, False, way, width)
+        return surface
 
 
 class MapSquare(game.Entity):
@@ -74,46 +463,60 @@ class MapSquare(game.Entity):
     _size = 0
     _fetching = None
     _map_surface = None
-    map_position = (0, 0)
+    _key = None
+    tile = None
+    needs_redraw = False
+    STYLE_VERSION = 2
 
-    def __init__(self, size, map_position, parent, *args, **kwargs):
+    def __init__(self, size, tile, parent, *args, **kwargs):
         self._mapper = pypboy.data.Maps()
+        self._mapper.fit_tile(tile)
         self._size = size
         self.parent = parent
-        self._map_surface = pygame.Surface((size * 2, size * 2))
-        self.map_position = map_position
+        self._map_surface = pygame.Surface((size, size))
+        self.tile = tile
         self.tags = {}
         super(MapSquare, self).__init__((size, size), *args, **kwargs)
 
-    def fetch_map(self):
-        self._fetching = threading.Thread(target=self._internal_fetch_map)
-        self._fetching.start()
+    def fetch_map(self, priority=0):
+        self._fetching = self._mapper.scheduler.submit(
+            self._internal_fetch_map, priority=priority, key=pypboy.data.tile_key(self.tile))
+
+    def _render_ways(self):
+        surface = pygame.Surface((self._size, self._size)).convert()
+        surface.fill((0, 0, 0))
+        draw_lines = pygame.draw.lines
+        for style, ways in self._mapper.draw_lists((self._size, self._size), (self._size / 2, self._size / 2)):
+            # too small for the wider lines to read
+            colour = config.MAP_WAY_STYLES[style][0]
+            for way in ways:
+                draw_lines(surface, colour, False, way, 1)
+        return surface
 
     def _internal_fetch_map(self):
-        self._mapper.fetch_grid(self.map_position)
-        self.redraw_map()
-        self.parent.redraw_map()
+        self._key = self._mapper.store_tile(self.tile)
+        # Loaded and drawn by the grid on the main thread, however many squares arrive per frame
+        self.needs_redraw = True
+        self.parent.invalidate()
 
     def redraw_map(self, coef=1):
-        self._map_surface.fill((0, 0, 0))
-        for way in self._mapper.transpose_ways((self._size, self._size), (self._size / 2, self._size / 2)):
-            pygame.draw.lines(
-                self._map_surface,
-                (85, 251, 167),
-                False,
-                way,
-                1
-            )
+        if self._key is not None and not self._mapper.tiles:
+            self._mapper.load_tiles([self._key])
+        if self._mapper.tiles:
+            version, complete = data_version(self._mapper.store, self._mapper.tiles)
+            self._map_surface = tile_cache.get((self._mapper.tiles[0], self._size, 'square', self.STYLE_VERSION, version),
+                                               self._render_ways, complete)
         for tag in self._mapper.transpose_tags((self._size, self._size), (self._size / 2, self._size / 2)):
             self.tags[tag[0]] = (tag[1] + self.position[0], tag[2] + self.position[1], tag[3])
         self.image.fill((0, 0, 0))
-        self.image.blit(self._map_surface, (-self._size / 2, -self._size / 2))
+        self.image.blit(self._map_surface, (0, 0))
 
 
 class MapGrid(game.Entity):
     _grid = None
-    _delta = 0.002
+    _zoom = config.MAP_TILE_ZOOM
     _starting_position = (0, 0)
+    _needs_redraw = False
 
     def __init__(self, starting_position, dimensions, *args, **kwargs):
         self._grid = []
@@ -122,34 +525,51 @@ class MapGrid(game.Entity):
         self._tag_surface = pygame.Surface(dimensions)
         super(MapGrid, self).__init__(dimensions, *args, **kwargs)
         self.tags = {}
+        self._labels = LabelLayout(config.FONTS[12])
+        self._placed_tags = None
+        self._placement = set()
         self.fetch_outwards()
 
+    def invalidate(self):
+        """
+        Ask for a redraw on the next frame. Safe to call from any thread.
+        """
+        self._needs_redraw = True
+
+    def render(self, *args, **kwargs):
+        if self._needs_redraw:
+            self._needs_redraw = False
+            for square in self._grid:
+                if square.needs_redraw:
+                    square.needs_redraw = False
+                    square.redraw_map()
+            self.redraw_map()
+        super(MapGrid, self).render(*args, **kwargs)
+
     def test_fetch(self):
+        zoom, centre_x, centre_y = pypboy.data.tile_at(self._starting_position[0], self._starting_position[1], self._zoom)
         for x in range(10):
             for y in range(5):
                 square = MapSquare(
                     100,
-                    (
-                        self._starting_position[0] + (self._delta * x),
-                        self._starting_position[1] - (self._delta * y)
-                    )
+                    (zoom, centre_x + x, centre_y + y),
+                    self
                 )
                 square.fetch_map()
                 square.position = (100 * x, 100 * y)
                 self._grid.append(square)
 
     def fetch_outwards(self):
+        zoom, centre_x, centre_y = pypboy.data.tile_at(self._starting_position[0], self._starting_position[1], self._zoom)
         for x in range(-4, 4):
             for y in range(-2, 2):
                 square = MapSquare(
                     86,
-                    (
-                        self._starting_position[0] + (self._delta * x),
-                        self._starting_position[1] - (self._delta * y)
-                    ),
+                    (zoom, centre_x + x, centre_y + y),
                     self
                 )
-                square.fetch_map()
+                # Fetch the squares nearest the centre of the grid first
+                square.fetch_map(priority=(x + 0.5) ** 2 + (y + 0.5) ** 2)
                 square.position = ((86 * x) + (self.dimensions[0] / 2) - 43, (86 * y) + (self.dimensions[1] / 2) - 43)
                 self._grid.append(square)
 
@@ -158,16 +578,18 @@ class MapGrid(game.Entity):
         for square in self._grid:
             self.tags.update(square.tags)
         self._tag_surface.fill((0, 0, 0))
+        if self.tags != self._placed_tags:
+            self._labels.clear()
+            self._placement = self._labels.place(
+                (name, int(tag[0]), int(tag[1]), name, tag[2]) for name, tag in self.tags.items())
+            self._placed_tags = self.tags
         for name in self.tags:
-            if self.tags[name][2] in config.AMENITIES:
-                image = config.AMENITIES[self.tags[name][2]]
-            else:
-                logging.info("Unknown amenity: %s" % self.tags[name][2])
-                image = config.MAP_ICONS['misc']
-            pygame.transform.scale(image, (10, 10))
-            self.image.blit(image, (self.tags[name][0], self.tags[name][1]))
+            self.image.blit(icon_atlas.get(self.tags[name][2], config.MAP_ICON_SIZES[0]),
+                            (self.tags[name][0], self.tags[name][1]))
+            if name not in self._placement:
+                continue
             # try:
-            text = config.FONTS[12].render(name, True, (95, 255, 177), (0, 0, 0))
+            text = self._labels.render(name)
             # text_width = text.get_size()[0]
             # 	pygame.draw.rect(
             # 		self,
@@ -17,6 +17,15 @@ class Module(pypboy.SubModule):
         self.add(mapgrid)
         mapgrid.rect[0] = 4
         mapgrid.rect[1] = 40
+        self.mapgrid = mapgrid
+
+    def handle_action(self, action, value=0):
+        if action == "dial_up":
+            self.mapgrid.move_map(0, -config.MAP_PAN_STEP)
+        elif action == "dial_down":
+            self.mapgrid.move_map(0, config.MAP_PAN_STEP)
+        else:
+            super(Module, self).handle_action(action, value)
 
     def handle_resume(self):
         self.parent.pypboy.header.headline = "DATA"
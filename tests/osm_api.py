@@ -0,0 +1,37 @@
+import os
+
+import requests
+
+
+class OsmFileAdapter(requests.adapters.BaseAdapter):
+    """
+    Stand-in for the OSM API that answers every request with a local
+    .osm file, for mounting on a Maps session in tests. The URLs asked
+    for are kept in requests and the timeouts they were given in timeouts.
+    Status codes put in errors are answered first, one per request.
+    """
+
+    def __init__(self, path):
+        super(OsmFileAdapter, self).__init__()
+        self.path = path
+        self.requests = []
+        self.timeouts = []
+        self.errors = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request.url)
+        self.timeouts.append(kwargs.get('timeout'))
+        response = requests.Response()
+        if self.errors:
+            response.status_code = self.errors.pop(0)
+        else:
+            response.status_code = 200 if os.path.exists(self.path) else 404
+        body = open(self.path, 'rb') if response.status_code == 200 else None
+        response.raw = requests.packages.urllib3.response.HTTPResponse(
+            body=body, status=response.status_code, preload_content=False)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,50 @@
+import threading
+import unittest
+
+from pypboy.data import FetchScheduler, queue
+
+
+class FetchSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = FetchScheduler(2)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.finished = queue.Queue()
+
+    def block(self):
+        self.started.set()
+        self.release.wait(5)
+        self.record('block')
+
+    def record(self, name):
+        self.finished.put((name, threading.current_thread().ident))
+
+    def wait(self, count):
+        return [self.finished.get(timeout=5) for i in range(count)]
+
+    def test_same_key_waits_for_the_running_job(self):
+        self.scheduler.submit(self.block, key='tile')
+        self.assertTrue(self.started.wait(5))
+        for name in 'ab':
+            self.scheduler.submit(self.record, (name,), key='tile')
+        self.scheduler.submit(self.record, ('other',), key='other tile')
+        self.assertEqual(self.wait(1)[0][0], 'other')
+        self.release.set()
+        runs = self.wait(3)
+        self.assertEqual([name for name, thread in runs], ['block', 'a', 'b'])
+        self.assertEqual(len(set(thread for name, thread in runs)), 1)
+
+    def test_cancelled_jobs_are_skipped(self):
+        self.scheduler.submit(self.block)
+        self.scheduler.submit(self.block)
+        self.assertTrue(self.started.wait(5))
+        self.scheduler.submit(self.record, ('a',), key='tile').cancel()
+        self.scheduler.submit(self.record, ('b',), key='tile')
+        self.release.set()
+        self.assertEqual(sorted(name for name, thread in self.wait(3)), ['b', 'block', 'block'])
+        self.assertTrue(self.finished.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
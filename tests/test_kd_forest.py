@@ -0,0 +1,99 @@
+import unittest
+
+import numpy
+
+from pypboy.data import KDForest, KDTree, haversine
+
+
+class KDForestTest(unittest.TestCase):
+    """
+    Every query checked against a haversine scan of the live points.
+    """
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(7)
+        self.forest = KDForest()
+        self.points = {}
+
+    def add(self, count, spread):
+        centre = (37.11, -93.36)
+        for i in range(count):
+            point_id = int(self.random.randint(10 ** 6))
+            point = (centre[0] + self.random.uniform(-spread, spread),
+                     centre[1] + self.random.uniform(-spread, spread))
+            self.forest.add(point_id, point)
+            self.points[point_id] = point
+
+    def remove(self, count):
+        for point_id in self.random.permutation(sorted(self.points))[:count].tolist():
+            self.forest.remove(point_id)
+            del self.points[point_id]
+
+    def brute_force(self, near):
+        return sorted((haversine(near, point), point_id) for point_id, point in self.points.items())
+
+    def check(self, queries=20):
+        self.assertEqual(len(self.forest), len(self.points))
+        for i in range(queries):
+            near = (37.11 + self.random.uniform(-0.05, 0.05), -93.36 + self.random.uniform(-0.05, 0.05))
+            expected = self.brute_force(near)
+            for k in (0, 1, 5, len(expected) + 3):
+                self.assertNearest(self.forest.nearest(near, k), expected[:k])
+            limit = expected[len(expected) // 3][0] if expected else 100.0
+            self.assertNearest(self.forest.nearest(near, 10, limit),
+                               [pair for pair in expected[:10] if pair[0] <= limit])
+            radius = limit * 1.5 + 1
+            # skip points so close to the edge that rounding decides them
+            within = dict((point_id, metres) for metres, point_id in self.forest.within(near, radius))
+            for metres, point_id in expected:
+                if abs(metres - radius) > 1e-3:
+                    self.assertEqual(point_id in within, metres < radius)
+
+    def assertNearest(self, found, expected):
+        self.assertEqual([point_id for metres, point_id in found], [point_id for metres, point_id in expected])
+        for (metres, point_id), (expected_metres, expected_id) in zip(found, expected):
+            self.assertAlmostEqual(metres, expected_metres, delta=1e-3)
+
+    def test_empty(self):
+        self.assertEqual(self.forest.nearest((37.11, -93.36), 3), [])
+        self.assertEqual(self.forest.within((37.11, -93.36), 1000), [])
+
+    def test_buffer_only(self):
+        self.add(KDForest.BUFFER_SIZE // 2, 0.01)
+        self.assertEqual(self.forest.trees, [])
+        self.check()
+
+    def test_merged_trees(self):
+        self.add(KDForest.BUFFER_SIZE * 11 + 5, 0.02)
+        self.assertTrue(len(self.forest.trees) > 1)
+        self.check()
+
+    def test_remove_and_rebuild(self):
+        self.add(500, 0.02)
+        self.remove(100)
+        self.check()
+        self.remove(250)
+        self.check()
+        self.add(200, 0.5)
+        self.check()
+
+    def test_moved_points(self):
+        self.add(300, 0.02)
+        for point_id in sorted(self.points)[:50]:
+            point = (37.11 + self.random.uniform(-0.03, 0.03), -93.36 + self.random.uniform(-0.03, 0.03))
+            self.forest.add(point_id, point)
+            self.points[point_id] = point
+        self.check()
+
+    def test_tree_visits_every_live_point(self):
+        points = self.random.randn(300, 3)
+        tree = KDTree(points, numpy.arange(300))
+        alive = self.random.rand(300) < 0.7
+        seen = []
+        tree.search(numpy.zeros(3), alive, lambda: float('inf'),
+                    lambda distances, serials: seen.extend(serials.tolist()))
+        self.assertEqual(sorted(seen), numpy.flatnonzero(alive).tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from pypboy.data import MapCache, MapStore, Maps
+from tests.osm_api import OsmFileAdapter
+
+OSM_FILE = os.path.join(os.path.dirname(__file__), 'data', 'map.osm')
+BOUNDS = (-93.366, 37.114, -93.364, 37.115)
+
+
+class MapCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss_then_hit(self):
+        cache = MapCache(self.directory, 1024, 60)
+        self.assertIsNone(cache.get('a'))
+        path = cache.put('a', [b'abc', b'def'])
+        self.assertEqual(cache.get('a'), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'size': 6})
+
+    def test_evicts_least_recently_used(self):
+        cache = MapCache(self.directory, 10, 60)
+        cache.put('a', [b'aaaa'])
+        cache.put('b', [b'bbbb'])
+        cache.get('a')
+        cache.put('c', [b'cccc'])
+        self.assertIsNone(cache.get('b'))
+        self.assertFalse(os.path.exists(cache.path('b')))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.size, 8)
+
+    def test_stale_entries_miss(self):
+        cache = MapCache(self.directory, 1024, 60)
+        cache.put('a', [b'abc'])
+        cache._entries['a']['fetched'] -= 120
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.misses, 1)
+
+    def test_stale_entries_allowed(self):
+        cache = MapCache(self.directory, 1024, 60)
+        path = cache.put('a', [b'abc'])
+        cache._entries['a']['fetched'] -= 120
+        self.assertEqual(cache.get('a', allow_stale=True), path)
+
+    def test_hits_are_saved_on_close(self):
+        cache = MapCache(self.directory, 10, 60)
+        cache.put('a', [b'aaaa'])
+        cache.put('b', [b'bbbb'])
+        index = os.path.join(self.directory, MapCache.INDEX_FILE)
+        with open(index) as f:
+            saved = f.read()
+        cache.get('a')
+        with open(index) as f:
+            self.assertEqual(f.read(), saved)
+        cache.close()
+        reopened = MapCache(self.directory, 10, 60)
+        self.assertEqual(list(reopened._entries), ['b', 'a'])
+
+
+class StoreAreaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = OsmFileAdapter(OSM_FILE)
+        self.mapper = Maps()
+        self.mapper.cache = MapCache(self.directory, 1024 * 1024, 60)
+        self.mapper.store = MapStore(1000)
+        self.mapper.database = None
+        self.mapper.session = requests.Session()
+        self.mapper.session.mount('http://', self.api)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fetches_once_then_reads_cache(self):
+        key = self.mapper.store_area(BOUNDS)
+        self.assertEqual(len(self.api.requests), 1)
+        self.assertEqual(self.api.timeouts, [Maps.FETCH_TIMEOUT])
+        self.assertEqual(self.mapper.store.tiles([key])[0].styles.tolist(), [3, 2])
+        self.mapper.store = MapStore(1000)
+        self.assertEqual(self.mapper.store_area(BOUNDS), key)
+        self.assertEqual(len(self.api.requests), 1)
+        self.assertEqual(self.mapper.cache.hits, 1)
+        found = self.mapper.find_poi('battle')
+        self.assertEqual([tag[2:] for tag in found], [(u'Battlefield Pharmacy', u'pharmacy')])
+        self.assertAlmostEqual(found[0][1], -93.3645)
+
+    def test_failed_fetch_is_not_cached(self):
+        self.api.path = os.path.join(self.directory, 'missing.osm')
+        self.assertIsNone(self.mapper.store_area(BOUNDS))
+        self.assertEqual(self.mapper.cache.stats()['entries'], 0)
+
+    def test_retries_server_errors(self):
+        self.mapper.FETCH_BACKOFF = 0
+        self.api.errors = [503, 429]
+        self.assertIsNotNone(self.mapper.store_area(BOUNDS))
+        self.assertEqual(len(self.api.requests), 3)
+
+    def test_gives_up_on_client_errors(self):
+        self.mapper.FETCH_BACKOFF = 0
+        self.api.errors = [403]
+        self.assertIsNone(self.mapper.store_area(BOUNDS))
+        self.assertEqual(len(self.api.requests), 1)
+
+    def test_stale_cache_used_when_fetch_fails(self):
+        key = self.mapper.store_area(BOUNDS)
+        self.mapper.cache._entries[key]['fetched'] -= 120
+        self.mapper.store = MapStore(1000)
+        self.api.path = os.path.join(self.directory, 'missing.osm')
+        self.assertEqual(self.mapper.store_area(BOUNDS), key)
+        self.assertEqual(len(self.api.requests), 2)
+        self.assertEqual(self.mapper.store.tiles([key])[0].styles.tolist(), [3, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
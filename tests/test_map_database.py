@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pypboy.data import MapDatabase
+
+OSM_FILE = os.path.join(os.path.dirname(__file__), 'data', 'map.osm')
+BOUNDS = (-93.366, 37.114, -93.364, 37.115)
+
+
+class MapDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = MapDatabase(os.path.join(self.directory, 'maps.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_import_and_query(self):
+        self.assertEqual(self.database.import_osm(OSM_FILE), 2)
+        self.assertTrue(self.database.covers((-93.3655, 37.1142, -93.3645, 37.1148)))
+        ways, tags = self.database.query(BOUNDS)
+        self.assertEqual(sorted(way[0] for way in ways), ['10', '11'])
+        self.assertEqual([tag[2:] for tag in tags.values()], [(u'Battlefield Pharmacy', u'pharmacy')])
+
+    def test_failed_import_keeps_previous_data(self):
+        self.database.import_osm(OSM_FILE)
+        broken = os.path.join(self.directory, 'broken.osm')
+        with open(OSM_FILE) as f:
+            text = f.read()
+        with open(broken, 'w') as f:
+            f.write(text[:text.index('<way id="11">')])
+        self.assertRaises(SyntaxError, self.database.import_osm, broken)
+        ways, tags = MapDatabase(self.database.path).query(BOUNDS)
+        self.assertEqual(sorted(way[0] for way in ways), ['10', '11'])
+        self.assertEqual(len(tags), 1)
+        self.assertEqual(self.database.import_osm(OSM_FILE), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+
+import numpy
+
+from pypboy.data import PcmStream
+
+
+class PcmStreamTest(unittest.TestCase):
+    """
+    Reads through the ring buffer checked against the whole file decoded
+    at once.
+    """
+    RATE = 8000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.random = numpy.random.RandomState(11)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, samples, width):
+        path = os.path.join(self.directory, 'track%d.wav' % width)
+        writer = wave.open(path, 'wb')
+        writer.setnchannels(samples.shape[1])
+        writer.setsampwidth(width)
+        writer.setframerate(self.RATE)
+        writer.writeframes(samples.astype({1: '<u1', 2: '<i2', 4: '<i4'}[width]).tostring())
+        writer.close()
+        return path
+
+    def check(self, path, expected, reads):
+        stream = PcmStream(path, seconds=0.5)
+        try:
+            for first, count in reads:
+                index = numpy.clip(numpy.arange(first, first + count), 0, len(expected) - 1)
+                numpy.testing.assert_array_equal(stream.read(first, count), expected[index])
+        finally:
+            stream.close()
+
+    def reads(self, length, count=200):
+        reads = [(-100, 300), (0, 1), (length - 50, 300), (length + 1000, 10), (0, self.RATE // 2)]
+        position = 0
+        # forward play with backward seeks and far jumps mixed in
+        for i in range(count):
+            choice = self.random.rand()
+            if choice < 0.1:
+                position = self.random.randint(-500, length + 500)
+            elif choice < 0.3:
+                position -= self.random.randint(1, 6000)
+            else:
+                position += self.random.randint(0, 3000)
+            reads.append((position, self.random.randint(1, 4000)))
+        return reads
+
+    def test_stereo_16_bit(self):
+        samples = self.random.randint(-32768, 32768, (self.RATE * 5, 2))
+        path = self.write(samples, 2)
+        self.check(path, samples.astype(numpy.float32), self.reads(len(samples)))
+
+    def test_mono_8_bit(self):
+        samples = self.random.randint(0, 256, (self.RATE * 3 + 17, 1))
+        path = self.write(samples, 1)
+        self.check(path, ((samples - 128) * 256.0).astype(numpy.float32), self.reads(len(samples)))
+
+    def test_32_bit(self):
+        samples = self.random.randint(-2 ** 31, 2 ** 31, (self.RATE * 2, 2))
+        path = self.write(samples, 4)
+        self.check(path, (samples * 2.0 ** -16).astype(numpy.float32), self.reads(len(samples), 50))
+
+    def test_read_larger_than_buffer(self):
+        path = self.write(numpy.zeros((self.RATE, 1)), 2)
+        stream = PcmStream(path, seconds=0.5)
+        self.assertRaises(ValueError, stream.read, 0, self.RATE)
+        stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
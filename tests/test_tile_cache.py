@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import pygame
+
+from pypboy.modules.data.entities import TileSurfaceCache
+
+
+def tile(colour):
+    surface = pygame.Surface((64, 64)).convert()
+    surface.fill(colour)
+    return surface
+
+
+class TileSurfaceCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pygame.display.init()
+        pygame.display.set_mode((64, 64), 0, 32)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reloads_tiles_saved_by_an_earlier_run(self):
+        cache = TileSurfaceCache(64 * 64 * 10, self.directory, 10 ** 6)
+        cache.get(('a', 1, 'map', 2, 'v1'), lambda: tile((200, 0, 0)))
+        cache.flush()
+        rendered = []
+        restarted = TileSurfaceCache(64 * 64 * 10, self.directory, 10 ** 6)
+        surface = restarted.get(('a', 1, 'map', 2, 'v1'), lambda: rendered.append(1) or tile((0, 0, 0)))
+        self.assertEqual(rendered, [])
+        self.assertEqual(surface.get_at((0, 0))[:3], (200, 0, 0))
+        # another data version is another tile
+        restarted.get(('a', 1, 'map', 2, 'v2'), lambda: rendered.append(1) or tile((0, 0, 0)))
+        self.assertEqual(rendered, [1])
+
+    def test_incomplete_tiles_stay_in_memory(self):
+        cache = TileSurfaceCache(64 * 64 * 10, self.directory, 10 ** 6)
+        cache.get(('a', 1, 'map', 2, 'v1'), lambda: tile((200, 0, 0)), False)
+        cache.flush()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_disk_use_is_bounded(self):
+        cache = TileSurfaceCache(64 * 64 * 10, self.directory, 1000)
+        for i in range(20):
+            cache.get(('t%d' % i, 1, 'map', 2, 'v1'), lambda: tile((i * 10, 0, 0)))
+            cache.flush()
+        names = os.listdir(self.directory)
+        self.assertTrue(names)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.directory, name)) for name in names), 1000)
+        self.assertIn('t19_1_map_2_v1.png', names)
+        self.assertNotIn('t0_1_map_2_v1.png', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
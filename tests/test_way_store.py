@@ -0,0 +1,102 @@
+import unittest
+
+import numpy
+
+from pypboy.data import SpatialGrid, WayStore, douglas_peucker
+
+
+def simplify(points, tolerance):
+    """
+    Textbook recursive Douglas-Peucker of one way, returning the indices
+    of the points it keeps, splitting at the first furthest point.
+    """
+    if len(points) < 3:
+        return list(range(len(points)))
+    origin = points[0]
+    direction = points[-1] - origin
+    between = points[1:-1] - origin
+    length = numpy.hypot(direction[0], direction[1])
+    if length > 0:
+        distances = numpy.abs(direction[0] * between[:, 1] - direction[1] * between[:, 0]) / length
+    else:
+        distances = numpy.hypot(between[:, 0], between[:, 1])
+    furthest = int(numpy.argmax(distances)) + 1
+    if distances[furthest - 1] <= tolerance:
+        return [0, len(points) - 1]
+    left = simplify(points[:furthest + 1], tolerance)
+    right = simplify(points[furthest:], tolerance)
+    return left + [furthest + i for i in right[1:]]
+
+
+class DouglasPeuckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(3)
+
+    def ways(self):
+        ways = [self.random.randn(n, 2).cumsum(axis=0) for n in self.random.randint(2, 60, 200)]
+        # degenerate ways: repeated points, a closed loop, a straight line
+        ways.append(numpy.zeros((5, 2)))
+        ways.append(numpy.array([[0.0, 0.0], [1.0, 1.0], [2.0, 0.0], [0.0, 0.0]]))
+        ways.append(numpy.column_stack((numpy.arange(10.0), numpy.arange(10.0))))
+        return ways
+
+    def test_matches_recursive(self):
+        ways = self.ways()
+        store = WayStore()
+        store.extend(ways)
+        for tolerance in (0.0, 0.1, 1.0, 5.0, 100.0):
+            keep = douglas_peucker(store.coords, store.offsets, tolerance)
+            for way, kept in zip(ways, store.split(keep)):
+                self.assertEqual(numpy.flatnonzero(kept).tolist(), simplify(way, tolerance))
+
+    def test_levels_match_recursive(self):
+        ways = self.ways()
+        store = WayStore()
+        store.extend(ways)
+        store.build_levels((1.0, 4.0))
+        simplified = ways
+        for (tolerance, level), expected_tolerance in zip(store.levels, (1.0, 4.0)):
+            self.assertEqual(tolerance, expected_tolerance)
+            simplified = [way[simplify(way, tolerance)] for way in simplified]
+            self.assertEqual(len(level), len(ways))
+            for way, expected in zip(level, simplified):
+                numpy.testing.assert_array_equal(way, expected)
+
+
+class SpatialGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(5)
+
+    def boxes(self, count):
+        low = self.random.rand(count, 2) * 10
+        # mostly small boxes, a few spanning much of the grid
+        return numpy.hstack((low, low + self.random.rand(count, 2) ** 4 * 8))
+
+    def check(self, boxes, queries=300):
+        grid = SpatialGrid(boxes)
+        boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        for i in range(queries):
+            x = numpy.sort(self.random.rand(2) * 16 - 3)
+            y = numpy.sort(self.random.rand(2) * 16 - 3)
+            expected = numpy.flatnonzero((boxes[:, 0] <= x[1]) & (boxes[:, 2] >= x[0]) &
+                                         (boxes[:, 1] <= y[1]) & (boxes[:, 3] >= y[0]))
+            self.assertEqual(grid.query((x[0], y[0], x[1], y[1])).tolist(), expected.tolist())
+
+    def test_matches_brute_force(self):
+        self.check(self.boxes(2000))
+
+    def test_edges(self):
+        self.check([])
+        self.check([(1, 1, 1, 1)])
+        # every box the same point, so the grid has no extent
+        self.check([(2, 3, 2, 3)] * 5)
+        boxes = self.boxes(50)
+        grid = SpatialGrid(boxes)
+        # touching edges count as overlapping
+        self.assertIn(0, grid.query((boxes[0, 2], boxes[0, 3], boxes[0, 2] + 1, boxes[0, 3] + 1)).tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()